@@ -1,5 +1,6 @@
 import logging
 import os
+import random
 import site
 import sys
 
@@ -7,6 +8,16 @@ approot = os.path.dirname(__file__)
 sys.path.append(os.path.join(approot, 'common'))
 sys.path.append(os.path.join(approot, 'lib'))
 
+# Appstats adds overhead to every recorded request so only a sample is
+# recorded, along with any request asking to be profiled.
+appstats_RECORD_FRACTION = 0.01
+
+def appstats_should_record(env):
+  from google.appengine.api import users
+  if env.get('HTTP_X_PULLDB_PROFILE') and users.is_current_user_admin():
+    return True
+  return random.random() < appstats_RECORD_FRACTION
+
 def webapp_add_wsgi_middleware(app):
   from google.appengine.ext.appstats import recording
   app = recording.appstats_wsgi_middleware(app)
@@ -0,0 +1,109 @@
+#pylint: disable=missing-docstring
+'''Cache of oauth token validation.
+
+Validated tokens are cached by a hash of the token and scope, first in
+process and then in memcache, so bursts of api calls with the same bearer
+token only pay for one validation rpc.  Invalid tokens are cached for a
+shorter time.  Failures of the oauth service are not cached, so a
+transient error does not reject a valid token until the entry expires.
+'''
+from collections import OrderedDict
+from hashlib import sha256
+import logging
+import threading
+from time import time
+
+from google.appengine.api import memcache
+from google.appengine.api import oauth
+
+VALID_TTL = 300
+INVALID_TTL = 60
+LOCAL_CACHE_SIZE = 1000
+
+_LOCAL = OrderedDict()
+_LOCK = threading.Lock()
+STATS = {'local': 0, 'memcache': 0, 'miss': 0, 'uncached': 0}
+
+
+def request_token(request):
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    if scheme.lower() in ('bearer', 'oauth') and token.strip():
+        return token.strip()
+
+def token_key(token, scope):
+    return sha256('%s %s' % (scope, token)).hexdigest()
+
+def _local_get(key):
+    with _LOCK:
+        entry = _LOCAL.get(key)
+        if entry and entry[0] > time():
+            return entry[1]
+        _LOCAL.pop(key, None)
+
+def _local_set(key, result, ttl):
+    with _LOCK:
+        _LOCAL.pop(key, None)
+        _LOCAL[key] = (time() + ttl, result)
+        while len(_LOCAL) > LOCAL_CACHE_SIZE:
+            _LOCAL.popitem(last=False)
+
+def _count(tier):
+    '''Count a lookup, returning the lookups and misses so far.'''
+    with _LOCK:
+        STATS[tier] += 1
+        lookups = STATS['local'] + STATS['memcache'] + STATS['miss']
+        return lookups, STATS['miss']
+
+def stats():
+    with _LOCK:
+        return dict(STATS)
+
+def _validate(scope):
+    '''Validation result of the current request for caching.
+
+    Errors other than an invalid token, such as
+    oauth.OAuthServiceFailureError, are raised.
+    '''
+    try:
+        user = oauth.get_current_user(scope)
+    except (oauth.InvalidOAuthTokenError,
+            oauth.InvalidOAuthParametersError) as error:
+        return {'valid': False, 'scope': scope, 'error': repr(error)}
+    return {'valid': True, 'scope': scope, 'user': user}
+
+def lookup(key, scope):
+    '''Cached validation result and the tier which provided it.'''
+    result = _local_get(key)
+    if result:
+        return result, 'local'
+    result = memcache.get(key, namespace='oauth')
+    if result:
+        ttl = VALID_TTL if result['valid'] else INVALID_TTL
+        _local_set(key, result, ttl)
+        return result, 'memcache'
+    result = _validate(scope)
+    ttl = VALID_TTL if result['valid'] else INVALID_TTL
+    memcache.set(key, result, ttl, namespace='oauth')
+    _local_set(key, result, ttl)
+    return result, 'miss'
+
+def get_current_user(request, scope, varz=None):
+    '''Cached equivalent of oauth.get_current_user.
+
+    Raises oauth.OAuthRequestError for invalid tokens, including cached
+    failures.  Requests without a bearer token are passed through.
+    '''
+    token = request_token(request)
+    if not token:
+        _count('uncached')
+        return oauth.get_current_user(scope)
+    result, tier = lookup(token_key(token, scope), scope)
+    lookups, misses = _count(tier)
+    if varz is not None:
+        varz.oauth_cache = tier
+        varz.oauth_hit_rate = round(1.0 * (lookups - misses) / lookups, 3)
+    if not result['valid']:
+        logging.debug('Cached oauth failure: %s', result.get('error'))
+        raise oauth.InvalidOAuthTokenError(result.get('error'))
+    return result['user']
@@ -1,24 +1,89 @@
 #pylint: disable=missing-docstring
+import calendar
+from datetime import datetime
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from hashlib import sha1
+import json
 import logging
 import os
+import zlib
 
+from google.appengine.api import memcache
 from google.appengine.api import oauth
 from google.appengine.api import users
+from google.appengine.ext import ndb
 
 # pylint: disable=F0401,E1002,E1101,C0103,W0201
 import jinja2
 import webapp2
 from webapp2 import Route # pylint: disable=W0611
 
+from pulldb import auth
+from pulldb import profiling
+from pulldb import varz
 from pulldb.varz import VarzContext
 
+# Bytes of json buffered before each write, and the gzip level used
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_COMPRESSION = 6
+TEMPLATE_PATH = os.path.join(os.path.curdir, 'template')
+# Check templates for changes on each use.  None enables this only on the
+# development server.
+TEMPLATE_AUTO_RELOAD = None
+_TEMPLATES = None
+
+def is_development():
+    return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+def template_environment():
+    '''Jinja2 environment shared by all handlers in the process.
+
+    Compiled templates are cached in the environment and their bytecode
+    in memcache, so a new instance does not need to parse templates that
+    another instance has already compiled.
+    '''
+    global _TEMPLATES # pylint: disable=global-statement
+    if _TEMPLATES is None:
+        auto_reload = TEMPLATE_AUTO_RELOAD
+        if auto_reload is None:
+            auto_reload = is_development()
+        _TEMPLATES = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATE_PATH),
+            extensions=['jinja2.ext.autoescape'],
+            auto_reload=auto_reload,
+            bytecode_cache=jinja2.MemcachedBytecodeCache(
+                memcache, prefix='jinja2/%s/' % os.environ.get(
+                    'CURRENT_VERSION_ID', 'dev')),
+        )
+    return _TEMPLATES
+
+def precompile_templates():
+    '''Load every template into the shared environment.'''
+    environment = template_environment()
+    compiled = 0
+    try:
+        names = environment.list_templates(
+            filter_func=lambda name: not name.startswith('.'))
+    except OSError as error:
+        logging.warn('Unable to list templates: %r', error)
+        return compiled
+    for name in names:
+        try:
+            environment.get_template(name)
+            compiled += 1
+        except jinja2.TemplateError as error:
+            logging.warn('Unable to compile template %s: %r', name, error)
+    logging.info('Precompiled %d templates', compiled)
+    return compiled
+
+
 class BaseHandler(webapp2.RequestHandler):
+    # Api call budgets for the request, defaults to varz.RPC_BUDGETS
+    rpc_budgets = None
+
     def __init__(self, *args, **kwargs):
         super(BaseHandler, self).__init__(*args, **kwargs)
-        self.templates = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(
-                os.path.join(os.path.curdir, 'template')),
-            extensions=['jinja2.ext.autoescape'])
+        self.templates = template_environment()
 
     def get_user_info(self):
         user = users.get_current_user()
@@ -38,6 +103,85 @@ class BaseHandler(webapp2.RequestHandler):
             }
         return user_info
 
+    def not_modified(self, entities, max_age=0):
+        '''Set cache validators and check them against the request.
+
+        entities may be models or keys.  If the client already holds the
+        current representation a 304 is set and True returned, in which
+        case the handler should return without writing a body.
+        '''
+        etag, last_modified = validators(entities)
+        self.response.headers['ETag'] = etag
+        if last_modified:
+            self.response.headers['Last-Modified'] = formatdate(
+                calendar.timegm(last_modified.utctimetuple()), usegmt=True)
+        self.response.headers['Cache-Control'] = (
+            'private, max-age=%d, must-revalidate' % max_age)
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            fresh = etag in tags or '*' in tags
+        else:
+            fresh = modified_since(
+                last_modified, self.request.headers.get('If-Modified-Since'))
+        if fresh:
+            self.response.set_status(304)
+            self.response.clear()
+            self.varz.not_modified = True
+        return fresh
+
+    def write_json_stream(self, items, serialise=None, key='results',
+                          extra=None):
+        '''Write an iterable as a json object of the form {key: [...]}.
+
+        Items are serialised one at a time as they are produced, so query
+        iterators are written batch by batch without building the whole
+        payload.  Output is gzip compressed when the client accepts it.
+        extra holds any other members of the response object.
+
+        On the python27 runtime webapp2 buffers the whole response body
+        before it is sent, so this does not stream to the client.  The
+        gain is lower peak memory, as the serialised items and the
+        uncompressed json are never held at once.
+
+        If serialising an item raises, the partial body and the gzip
+        headers are cleared before the error propagates, so an error
+        response is not labelled as compressed.
+        '''
+        if serialise is None:
+            from pulldb.models.base import model_to_dict
+            serialise = model_to_dict
+        self.response.headers['Content-Type'] = 'application/json'
+        compress = accepts_gzip(self.request)
+        if compress:
+            self.response.headers['Content-Encoding'] = 'gzip'
+            self.response.headers['Vary'] = 'Accept-Encoding'
+        stream = JsonStream(self.response.out, compress=compress)
+        try:
+            stream.write('{')
+            for name, value in sorted((extra or {}).items()):
+                stream.write(
+                    '%s: %s, ' % (json.dumps(name), json.dumps(value)))
+            stream.write('%s: [' % json.dumps(key))
+            count = 0
+            for item in items:
+                if count:
+                    stream.write(', ')
+                stream.write(json.dumps(serialise(item)))
+                count += 1
+            stream.write(']}')
+            stream.close()
+        except Exception:
+            self.response.clear()
+            for header in ('Content-Encoding', 'Vary'):
+                if header in self.response.headers:
+                    del self.response.headers[header]
+            raise
+        self.varz.response_items = count
+        self.varz.response_bytes = stream.raw_size
+        self.varz.response_compressed_bytes = stream.size
+        return count
+
     def base_template_values(self):
         template_values = {
             'url_path': self.request.path,
@@ -48,8 +192,15 @@ class BaseHandler(webapp2.RequestHandler):
     @VarzContext('handler')
     def dispatch(self):
         # pylint: disable=protected-access
-        self.varz.handler_type = 'base'
-        super(BaseHandler, self).dispatch()
+        if not self.varz.handler_type:
+            self.varz.handler_type = 'base'
+        self.varz.url = route_template(self.request)
+        self.varz.set_rpc_budgets(self.rpc_budgets)
+        with profiling.sampled(self.request, type(self).__name__) as profile:
+            if profile:
+                self.varz.profiled = True
+            super(BaseHandler, self).dispatch()
+        self.varz.status = self.response.status_int
 
 
 class OauthHandler(BaseHandler):
@@ -58,7 +209,8 @@ class OauthHandler(BaseHandler):
         self.varz.handler_type = 'oauth'
         self.scope = 'https://www.googleapis.com/auth/userinfo.email'
         try:
-            user = oauth.get_current_user(self.scope)
+            user = auth.get_current_user(
+                self.request, self.scope, self.varz)
         except oauth.OAuthRequestError as error:
             logging.warn('Unable to determine user for request')
             logging.debug(error)
@@ -74,7 +226,8 @@ class TaskHandler(BaseHandler):
         self.varz.handler_type = 'task'
         self.scope = 'https://www.googleapis.com/auth/userinfo.email'
         try:
-            user = oauth.get_current_user(self.scope)
+            user = auth.get_current_user(
+                self.request, self.scope, self.varz)
         except oauth.OAuthRequestError as error:
             logging.info('Unable to determine user for request')
             logging.debug(error)
@@ -88,5 +241,185 @@ class TaskHandler(BaseHandler):
         super(TaskHandler, self).dispatch()
 
 
+class JobHandler(TaskHandler):
+    '''Start a registered job, or report its progress with ?status=1.
+
+    Subclasses set job to the name of a job registered in
+    pulldb.models.jobs.  Request parameters other than status are passed
+    to the job.
+    '''
+    job = None
+
+    def get(self):
+        # Models are imported on first use so other handlers don't load them
+        from pulldb.models import jobs
+        self.response.headers['Content-Type'] = 'application/json'
+        if self.request.get('status'):
+            self.response.write(json.dumps(jobs.status(self.job)))
+            return
+        params = dict(
+            (name, self.request.get(name))
+            for name in self.request.arguments() if name != 'status')
+        shard_list = jobs.start(self.job, **params)
+        self.response.write(json.dumps({
+            'name': self.job,
+            'shards': shard_list,
+        }))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    '''Handle /_ah/warmup by loading what a cold request would need.
+
+    See pulldb.startup.warmup for the steps, which are reported with
+    their timings.
+    '''
+    def get(self):
+        from pulldb import startup
+        timings = startup.warmup()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(timings, sort_keys=True))
+
+
+class VarzHandler(BaseHandler):
+    '''Report varz metrics aggregated across instances.
+
+    With ?instance=1 the cache statistics of this instance are reported.
+    '''
+    def get(self):
+        if not users.is_current_user_admin():
+            self.abort(403)
+        self.response.headers['Content-Type'] = 'application/json'
+        if self.request.get('instance'):
+            from pulldb.models import entity_cache
+            # Caches local to the instance which served this request
+            report = {
+                'entity_cache': entity_cache.stats(),
+                'oauth_cache': auth.stats(),
+            }
+        else:
+            try:
+                minutes = int(self.request.get('minutes', 60))
+            except ValueError:
+                self.abort(400)
+            if not 0 < minutes <= varz.WINDOW_TTL // 60:
+                self.abort(400)
+            varz.REGISTRY.flush()
+            report = varz.aggregate(minutes)
+        self.response.write(json.dumps(report, sort_keys=True, indent=2))
+
+
+class ProfileHandler(BaseHandler):
+    '''Report the hottest functions of sampled handler profiles.'''
+    def get(self):
+        if not users.is_current_user_admin():
+            self.abort(403)
+        try:
+            limit = int(self.request.get('limit', 25))
+        except ValueError:
+            self.abort(400)
+        if limit < 1:
+            self.abort(400)
+        sort = self.request.get('sort', 'cumulative')
+        if sort not in ('calls', 'total', 'cumulative'):
+            self.abort(400)
+        handlers = self.request.get_all('handler')
+        if not handlers:
+            handlers = profiling.profiled_handlers()
+        report = dict(
+            (handler, profiling.top_functions(handler, limit, sort))
+            for handler in handlers)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report, sort_keys=True, indent=2))
+
+
+class JsonStream(object):
+    '''Buffered, optionally gzip compressed, writer of json text.'''
+    def __init__(self, out, compress=False, chunk_size=STREAM_CHUNK_SIZE):
+        self.out = out
+        self.chunk_size = chunk_size
+        self.raw_size = 0
+        self.size = 0
+        self._buffer = []
+        self._buffered = 0
+        self._compressor = None
+        if compress:
+            self._compressor = zlib.compressobj(
+                STREAM_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def write(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self._buffer.append(text)
+        self._buffered += len(text)
+        self.raw_size += len(text)
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def _emit(self, data):
+        if data:
+            self.size += len(data)
+            self.out.write(data)
+
+    def flush(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self._emit(data)
+
+    def close(self):
+        self.flush()
+        if self._compressor:
+            self._emit(self._compressor.flush())
+            self._compressor = None
+
+
+def accepts_gzip(request):
+    encodings = request.headers.get('Accept-Encoding', '')
+    return 'gzip' in [
+        encoding.split(';')[0].strip() for encoding in encodings.split(',')]
+
+def validators(entities):
+    '''ETag and last modified time for a response built from entities.
+
+    Models with a changed timestamp are identified by key and timestamp.
+    Other models are identified by their content.  Keys identify only
+    membership of the response.
+    '''
+    digest = sha1()
+    last_modified = None
+    for entity in entities:
+        if isinstance(entity, ndb.Key):
+            digest.update(entity.urlsafe())
+            continue
+        digest.update(entity.key.urlsafe())
+        changed = getattr(entity, 'changed', None)
+        if isinstance(changed, datetime):
+            digest.update(changed.isoformat())
+            if last_modified is None or changed > last_modified:
+                last_modified = changed
+        else:
+            digest.update(repr(sorted(entity.to_dict().items())))
+    return '"%s"' % digest.hexdigest(), last_modified
+
+def modified_since(last_modified, header):
+    '''True if an If-Modified-Since header is at least last_modified.'''
+    if not last_modified or not header:
+        return False
+    parsed = parsedate_tz(header)
+    if not parsed:
+        return False
+    return int(calendar.timegm(last_modified.utctimetuple())) <= mktime_tz(
+        parsed)
+
+def route_template(request):
+    route = getattr(request, 'route', None)
+    template = getattr(route, 'template', None)
+    return template or request.path
+
+
 def create_app(handlers, debug=True, *args, **kwargs):
+    varz.install_rpc_hooks()
+    varz.install_shutdown_hook()
     return webapp2.WSGIApplication(handlers, debug=debug, *args, **kwargs)
@@ -0,0 +1,410 @@
+#pylint: disable=missing-docstring
+'''Offline import of ComicVine dumps into the datastore.
+
+Dumps are files of newline delimited json records, one ComicVine detail
+resource per line.  Kinds are imported in dependency order (publishers,
+volumes, story arcs, then issues) so that references resolve to entities
+which already exist.  Within a kind, batches of records are built into
+entities through the model apply_changes logic by several worker threads
+and written with put_multi.  The volumes and arcs referred to by a batch
+of issues are checked with one get_multi, and ComicVine is never called,
+so references to arcs missing from the dumps are dropped with a warning.
+
+Progress is checkpointed to a json file after each batch as the number of
+records of each kind completed, so an interrupted import resumes where it
+stopped.  The offsets of records which failed are saved with it and
+retried when the import is resumed.  Records already imported are merged
+like any other update, so replaying a batch is harmless.
+
+Entities are written directly, so the updates of derived entities which
+follow an online issue change are not queued.  Once an import is done,
+rebuild them by running the volume_statistics, arc_statistics and
+arc_membership jobs, releases.backfill_releases, and streams.rebuild_stream
+for each stream.  Pulls are not created for imported issues.
+
+    python -m pulldb.bulkimport --datastore catalog.datastore \\
+        --publishers publishers.ndjson --volumes volumes.ndjson \\
+        --arcs arcs.ndjson --issues issues.ndjson
+'''
+import argparse
+from datetime import datetime
+import gzip
+import json
+import logging
+import os
+import Queue
+import threading
+from time import time
+
+from google.appengine.ext import ndb # pylint: disable=import-error
+
+from pulldb.models import arcs
+from pulldb.models import entity_cache
+from pulldb.models import issues
+from pulldb.models import publishers
+from pulldb.models import volumes
+
+IMPORT_ORDER = ['publishers', 'volumes', 'arcs', 'issues']
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_THREADS = 4
+REPORT_INTERVAL = 10
+
+
+def read_lines(path):
+    '''Yield the non empty lines of a dump.'''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path) as dump:
+        for line in dump:
+            line = line.strip()
+            if line:
+                yield line
+
+def read_records(path, skip=0):
+    '''Yield the json records of a dump, skipping the first skip.'''
+    for offset, line in enumerate(read_lines(path)):
+        if offset >= skip:
+            yield json.loads(line)
+
+def read_records_at(path, offsets):
+    '''Yield (offset, record) for the records of a dump at offsets.'''
+    offsets = set(offsets)
+    for offset, line in enumerate(read_lines(path)):
+        if offset in offsets:
+            yield offset, json.loads(line)
+
+def batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def setup_local_stubs(datastore_path, app_id='pulldb'):
+    '''Point the api proxy at a local file backed datastore.'''
+    # pylint: disable=import-error
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.setup_env(app_id=app_id, overwrite=True)
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        datastore_file=datastore_path, save_changes=True, use_sqlite=True)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    return bed
+
+
+class Checkpoint(object):
+    '''Records completed and failed per kind, saved to a json file.
+
+    Batches finish out of order so the saved position only advances over
+    a contiguous run of completed batches.  The offsets of records within
+    completed batches which failed are saved separately.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.position = {}
+        self.failed = {}
+        self._finished = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as checkpoint:
+                saved = json.load(checkpoint)
+            self.position = saved.get('position', {})
+            self.failed = saved.get('failed', {})
+
+    def start(self, kind):
+        return self.position.get(kind, 0)
+
+    def failed_offsets(self, kind):
+        return sorted(self.failed.get(kind, []))
+
+    def retried(self, kind, offsets, failed):
+        '''Replace failed offsets which were retried by those still failing.'''
+        with self._lock:
+            remaining = set(self.failed.get(kind, [])) - set(offsets)
+            remaining.update(failed)
+            self.failed[kind] = sorted(remaining)
+            self.save()
+
+    def complete(self, kind, offset, size, failed=()):
+        with self._lock:
+            if failed:
+                self.failed[kind] = sorted(
+                    set(self.failed.get(kind, [])) | set(failed))
+            finished = self._finished.setdefault(kind, {})
+            finished[offset] = size
+            position = self.position.get(kind, 0)
+            while position in finished:
+                position += finished.pop(position)
+            self.position[kind] = position
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = '%s.tmp' % self.path
+        with open(temp_path, 'w') as checkpoint:
+            json.dump({'position': self.position, 'failed': self.failed},
+                      checkpoint)
+        os.rename(temp_path, self.path)
+
+
+class Progress(object):
+    def __init__(self, kind):
+        self.kind = kind
+        self.records = 0
+        self.written = 0
+        self.errors = 0
+        self.start = time()
+        self._reported = time()
+        self._lock = threading.Lock()
+
+    def add(self, records, written, errors):
+        with self._lock:
+            self.records += records
+            self.written += written
+            self.errors += errors
+            if time() - self._reported > REPORT_INTERVAL:
+                self._reported = time()
+                logging.info('%s', self)
+
+    def rate(self):
+        elapsed = time() - self.start
+        return self.written / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return '%s: %d records, %d written, %d errors, %.1f entities/s' % (
+            self.kind, self.records, self.written, self.errors, self.rate())
+
+
+def issue_references(record):
+    '''Keys of the volume and story arcs an issue record refers to.'''
+    keys = []
+    if record.get('volume'):
+        keys.append(ndb.Key('Volume', str(record['volume']['id'])))
+    for arc in record.get('story_arc_credits') or []:
+        keys.append(ndb.Key('StoryArc', str(arc['id'])))
+    return keys
+
+def publisher_entity(record, existing, known):
+    # pylint: disable=unused-argument
+    if existing:
+        return None
+    publisher = publishers.Publisher(
+        key=ndb.Key(publishers.Publisher, str(record['id'])),
+        identifier=record['id'],
+        name=record['name'],
+        json=record,
+    )
+    if record.get('image'):
+        publisher.image = record['image'].get('tiny_url')
+    return publisher
+
+def volume_entity(record, existing, known):
+    # pylint: disable=unused-argument
+    volume = existing or volumes.Volume(
+        key=ndb.Key(volumes.Volume, str(record['id'])),
+        identifier=record['id'],
+        last_updated=datetime.min,
+    )
+    if record.get('publisher'):
+        volume.publisher = ndb.Key(
+            'Publisher', str(record['publisher']['id']))
+    updated, _ = volume.has_updates(record)
+    if existing and not updated:
+        return None
+    volume.apply_changes(record)
+    return volume
+
+def arc_entity(record, existing, known):
+    # pylint: disable=unused-argument
+    arc = existing or arcs.StoryArc(
+        key=ndb.Key(arcs.StoryArc, str(record['id'])),
+        identifier=record['id'],
+        last_updated=datetime.min,
+    )
+    if record.get('publisher'):
+        arc.publisher = ndb.Key(
+            'Publisher', str(record['publisher']['id']))
+    updated, _ = arc.has_updates(record)
+    if existing and not updated:
+        return None
+    arc.apply_changes(record)
+    return arc
+
+def issue_entity(record, existing, known):
+    '''Build an issue, keeping only references to entities in known.'''
+    issue = existing
+    if not issue:
+        issue = issues.Issue(
+            key=ndb.Key(issues.Issue, str(record['id'])),
+            identifier=record['id'],
+            last_updated=datetime.min,
+            volume=ndb.Key('Volume', str(record['volume']['id'])),
+        )
+    # Arcs which will be dropped are left out of the check, otherwise
+    # the issue would always appear to have moved collection.
+    checked = dict(record, story_arc_credits=[
+        arc for arc in record.get('story_arc_credits', [])
+        if ndb.Key('StoryArc', str(arc['id'])) in known])
+    updated, _ = issue.has_updates(checked)
+    if existing and not updated:
+        return None
+    issue.apply_changes(record, resolve=False)
+    missing = [key for key in issue_references(record) if key not in known]
+    if missing:
+        logging.warn('Issue %s refers to missing %s', record['id'], ', '.join(
+            '%s %s' % (key.kind(), key.id()) for key in missing))
+        issue.collection = [
+            key for key in issue.collection
+            if key.kind() != 'StoryArc' or key not in missing]
+    return issue
+
+BUILDERS = {
+    'publishers': ('Publisher', publisher_entity),
+    'volumes': ('Volume', volume_entity),
+    'arcs': ('StoryArc', arc_entity),
+    'issues': ('Issue', issue_entity),
+}
+
+
+def known_references(kind, records):
+    '''Keys referred to by a batch of records which exist.'''
+    if kind != 'issues':
+        return set()
+    referenced = list(set(
+        key for record in records for key in issue_references(record)))
+    return set(
+        key for key, entity in zip(referenced, ndb.get_multi(referenced))
+        if entity)
+
+def import_batch(kind, records):
+    '''Build and write the entities for a batch of records.
+
+    Returns the number of entities written and the indexes of the records
+    which failed.
+    '''
+    model_kind, builder = BUILDERS[kind]
+    keys = [ndb.Key(model_kind, str(record['id'])) for record in records]
+    known = known_references(kind, records)
+    entities = []
+    failed = []
+    for index, (record, existing) in enumerate(
+            zip(records, ndb.get_multi(keys))):
+        try:
+            entity = builder(record, existing, known)
+        except Exception as error: # pylint: disable=broad-except
+            logging.warn('Unable to import %s %r: %r',
+                         kind, record.get('id'), error)
+            failed.append(index)
+            continue
+        if entity:
+            entities.append(entity)
+    if entities:
+        entity_cache.put_multi(entities)
+    return len(entities), failed
+
+def retry_failed(kind, path, checkpoint, progress,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    '''Import again the records of a dump which failed previously.'''
+    offsets = checkpoint.failed_offsets(kind)
+    if not offsets:
+        return
+    logging.info('Retrying %d failed %s records', len(offsets), kind)
+    failed = []
+    for batch in batches(read_records_at(path, offsets), batch_size):
+        written, errors = import_batch(kind, [item[1] for item in batch])
+        progress.add(len(batch), written, len(errors))
+        failed.extend(batch[index][0] for index in errors)
+    checkpoint.retried(kind, offsets, failed)
+
+def import_kind(kind, path, checkpoint, threads=DEFAULT_THREADS,
+                batch_size=DEFAULT_BATCH_SIZE):
+    '''Import one dump using a pool of worker threads.'''
+    work = Queue.Queue(maxsize=threads * 2)
+    progress = Progress(kind)
+    retry_failed(kind, path, checkpoint, progress, batch_size)
+
+    def worker():
+        # Entities are not read again, so don't let the context cache grow
+        context = ndb.get_context()
+        context.set_cache_policy(False)
+        context.set_memcache_policy(False)
+        while True:
+            item = work.get()
+            try:
+                if item is None:
+                    return
+                offset, records = item
+                written, failed = import_batch(kind, records)
+                progress.add(len(records), written, len(failed))
+                checkpoint.complete(kind, offset, len(records),
+                                    [offset + index for index in failed])
+            except Exception as error: # pylint: disable=broad-except
+                logging.exception('Batch of %s at %d failed: %r',
+                                  kind, offset, error)
+            finally:
+                work.task_done()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    offset = checkpoint.start(kind)
+    if offset:
+        logging.info('Resuming %s after %d records', kind, offset)
+    for batch in batches(read_records(path, offset), batch_size):
+        work.put((offset, batch))
+        offset += len(batch)
+    for _ in workers:
+        work.put(None)
+    work.join()
+    logging.info('Imported %s', progress)
+    return progress
+
+def import_dumps(paths, checkpoint_path=None, threads=DEFAULT_THREADS,
+                 batch_size=DEFAULT_BATCH_SIZE):
+    '''Import dumps given as {kind: path} in dependency order.'''
+    checkpoint = Checkpoint(checkpoint_path)
+    results = []
+    for kind in IMPORT_ORDER:
+        if paths.get(kind):
+            results.append(import_kind(
+                kind, paths[kind], checkpoint, threads, batch_size))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--datastore', required=True,
+                        help='local datastore file to import into')
+    parser.add_argument('--app-id', default='pulldb')
+    for kind in IMPORT_ORDER:
+        parser.add_argument('--%s' % kind, help='%s dump file' % kind)
+    parser.add_argument('--checkpoint',
+                        help='progress file (default: <datastore>.progress)')
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    setup_local_stubs(args.datastore, args.app_id)
+    paths = dict((kind, getattr(args, kind)) for kind in IMPORT_ORDER)
+    start = time()
+    results = import_dumps(
+        paths, args.checkpoint or '%s.progress' % args.datastore,
+        args.threads, args.batch_size)
+    written = sum(progress.written for progress in results)
+    for progress in results:
+        logging.info('%s', progress)
+    elapsed = time() - start
+    logging.info('Total: %d entities in %.1fs, %.1f entities/s',
+                 written, elapsed, written / elapsed if elapsed else 0.0)
+    if paths.get('issues'):
+        logging.info('Derived entities were not updated, run the rebuild '
+                     'jobs listed in the bulkimport documentation')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 # Copyright 2013 Russell Heilling
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+from pulldb.models import entity_cache
+
 class Setting(ndb.Model):
   '''Setting object in datastore.
 
@@ -8,3 +11,28 @@ class Setting(ndb.Model):
   '''
   name = ndb.StringProperty()
   value = ndb.StringProperty()
+
+def setting_value(name, default=None, cast=None):
+  '''Fetch a setting value, cached in memcache.
+
+  Returns default if there is no such setting.  Values are stored as
+  strings so cast may be used to convert them.
+  '''
+  value = memcache.get(name, namespace='settings')
+  if value is None:
+    setting = Setting.query(Setting.name == name).get()
+    if not setting:
+      return default
+    value = setting.value
+    memcache.set(name, value, 3600, namespace='settings')
+  if cast:
+    value = cast(value)
+  return value
+
+def set_setting(name, value):
+  setting = Setting.query(Setting.name == name).get()
+  if not setting:
+    setting = Setting(name=name)
+  setting.value = str(value)
+  entity_cache.put(setting)
+  memcache.delete(name, namespace='settings')
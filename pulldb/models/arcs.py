@@ -3,14 +3,16 @@
 from datetime import datetime
 import logging
 
-from google.appengine.api import search #pylint: disable=import-error
 from google.appengine.ext import ndb #pylint: disable=import-error
 
-from dateutil.parser import parse as parse_date
-
 from pulldb.models import base
 from pulldb.models import comicvine
+from pulldb.models import documents
+from pulldb.models import entity_cache
+from pulldb.models import loader
+from pulldb.models import payloads
 from pulldb.models import publishers
+from pulldb.models import shards
 from pulldb.models.properties import ImageProperty
 
 
@@ -49,12 +51,15 @@ class StoryArc(ndb.Model):
             'site_detail_url', 'indexed', 'shard',
         ]
 
+    def _pre_put_hook(self):
+        shards.assign_shard(self)
+
     def apply_changes(self, data):
         merged_data = self.json or {}
         merged_data.update(data)
         data=merged_data
 
-        self.json = data
+        self.json = payloads.trim_payload('StoryArc', data)
         self.name = data.get('name', self.name)
         self.site_detail_url = data.get('site_detail_url', self.site_detail_url)
         if data.get('image'):
@@ -62,14 +67,11 @@ class StoryArc(ndb.Model):
         if data.get('first_appeared_in_issue'):
             first_issue_key = ndb.Key(
                 'Issue', str(data['first_appeared_in_issue']['id']))
-            if self.first_issue != first_issue_key:
-                self.first_issue = first_issue_key
-                # Don't fetch the issue data here, queue for batch refresh
-                self.complete = False
+            self.first_issue = first_issue_key
 
         last_updated = data.get('date_last_updated')
         if last_updated:
-            last_updated = parse_date(last_updated)
+            last_updated = base.parse_date(last_updated)
         else:
             last_updated = datetime.min
         if last_updated > self.last_updated:
@@ -84,7 +86,7 @@ class StoryArc(ndb.Model):
 
         new_data_date = new_data.get('date_last_updated')
         if new_data_date:
-            last_update = parse_date(new_data_date)
+            last_update = base.parse_date(new_data_date)
         else:
             last_update = datetime.min
 
@@ -94,38 +96,20 @@ class StoryArc(ndb.Model):
         return updates, last_update
 
     def index_document(self, batch=False):
-        document_fields = [
-            search.TextField(name='name', value=self.name),
-            search.NumberField(name='arc_id', value=self.identifier),
-        ]
+        document = documents.DocumentBuilder(str(self.identifier))
+        document.add_text('name', self.name, documents.PRIORITY_REQUIRED)
+        document.add_number('arc_id', self.identifier,
+                            documents.PRIORITY_REQUIRED)
         if self.json:
-            aliases = self.json.get('aliases')
-            if aliases:
-                for alias in aliases:
-                    document_fields.append(
-                        search.TextField(
-                            name='alias', value=alias))
-            deck = self.json.get('deck')
-            if deck:
-                document_fields.append(
-                    search.TextField(name='deck', value=deck))
-            description = self.json.get('description')
-            if description:
-                document_fields.append(
-                    search.HtmlField(name='description', value=description))
-
-        arc_doc = search.Document(
-            doc_id=str(self.identifier),
-            fields=document_fields
-        )
+            for alias in self.json.get('aliases') or []:
+                document.add_text('alias', alias, documents.PRIORITY_HIGH)
+            document.add_text('deck', self.json.get('deck'))
+            document.add_description(self.json.get('description'))
+
+        arc_doc = document.build()
         if batch:
             return arc_doc
-        try:
-            index = search.Index(name="arcs")
-            index.put(arc_doc)
-        except search.Error as error:
-            logging.exception('Put failed: %r', error)
-
+        documents.put_document(documents.ARC_INDEX, arc_doc)
 
 def identify_arc(arc_data):
     arc_id = None
@@ -149,7 +133,7 @@ def arc_key(arc_data, create=True, reindex=False, batch=False):
         raise NoSuchArc(message)
 
     key = ndb.Key(StoryArc, str(arc_id))
-    arc = key.get()
+    arc = entity_cache.get(key)
     changed = False
     if create and not arc:
         if 'publisher' not in arc_data:
@@ -185,14 +169,14 @@ def arc_key(arc_data, create=True, reindex=False, batch=False):
         logging.info('Saving arc updates: %r[%r]',
                      arc.identifier, arc.last_updated)
         if batch:
-            return arc.put_async()
-        arc.put()
+            return entity_cache.put_async(arc)
+        entity_cache.put(arc)
 
     return key
 
 @ndb.tasklet
 def arc_context(arc):
-    publisher = yield arc.publisher.get_async()
+    publisher = yield loader.load(arc.publisher)
     raise ndb.Return({
         'arc': arc,
         'publisher': publisher,
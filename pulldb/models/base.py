@@ -38,6 +38,11 @@ def model_to_dict(model, json=False):
 
     return model_dict
 
+def parse_date(value):
+    '''Parse a date string with dateutil, imported on first use.'''
+    from dateutil.parser import parse # pylint: disable=import-error
+    return parse(value)
+
 def model_to_json(model):
     'Convert a model instance to json'
     return json.dumps(model_to_dict(model))
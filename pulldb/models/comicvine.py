@@ -14,8 +14,9 @@ from google.appengine.api.urlfetch_errors import DownloadError
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import tasklets
 
-from pulldb.models.admin import Setting
+from pulldb.models import admin
 from pulldb.varz import VarzContext
+from pulldb.varz import current_varz
 
 _API = None
 
@@ -30,6 +31,10 @@ class ApiError(Exception):
         )
 
 
+class MissingApiKeyError(Exception):
+    pass
+
+
 class BadResponse(object):
     status_code = 500
     content = '{}'
@@ -114,8 +119,10 @@ class Comicvine(object):
     #pylint: disable=too-few-public-methods
     def __init__(self):
         self.api_base = 'https://www.comicvine.com/api'
-        self.api_key = Setting.query(
-            Setting.name == 'comicvine_api_key').get().value
+        self.api_key = admin.setting_value('comicvine_api_key')
+        if not self.api_key:
+            raise MissingApiKeyError(
+                'The comicvine_api_key setting has not been set')
         self.count = 0
         self.types = self._fetch_types()
 
@@ -165,30 +172,33 @@ class Comicvine(object):
 
     @VarzContext('cvstats')
     def _fetch_with_retry(self, url, retries=3, **kwargs):
-        self.varz.url = url.replace(self.api_key, 'XXXX')
+        # The api object is shared between requests, so use the varz of
+        # the current context rather than self.varz
+        varz = current_varz()
+        varz.url = url.replace(self.api_key, 'XXXX')
         for i in range(retries):
             try:
-                self.varz.retries = i
+                varz.retries = i
                 logging.info('Fetching comicvine resource %r (%d/%d)',
                              url, i, retries)
                 start = time()
                 response = urlfetch.fetch(url, **kwargs)
                 self.count += 1
             except (DeadlineExceededError, DownloadError) as err:
-                self.varz.status = 500
+                varz.status = 500
                 logging.exception(err)
             else:
-                self.varz.latency = time() - start
-                self.varz.size = len(response.content)
-                self.varz.http_status = response.status_code
+                varz.latency = time() - start
+                varz.size = len(response.content)
+                varz.http_status = response.status_code
                 try:
                     result = json.loads(response.content)
                     status_code = result.get('status_code', 0)
-                    self.varz.status = status_code
+                    varz.status = status_code
                     if status_code >= 100:
                         raise ApiError(result['status_code'], result['error'])
                 except (TypeError, ValueError):
-                    self.varz.status = 500
+                    varz.status = 500
                 break
             # Exponential backoff with random delay in case of error
             sleep(2**i * 0.1 + random())
@@ -0,0 +1,210 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Helpers to build search documents within a size budget.'''
+from HTMLParser import HTMLParser
+import logging
+import re
+from time import time
+
+from google.appengine.api import memcache #pylint: disable=import-error
+
+ISSUE_INDEX = 'issues'
+VOLUME_INDEX = 'volumes'
+ARC_INDEX = 'arcs'
+
+# Fields are added in priority order until the document budget is used.
+# Required fields are always included regardless of budget.
+PRIORITY_REQUIRED = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+PRIORITY_LOW = 3
+
+# Sizes are in bytes of utf-8 encoded field data.
+DOCUMENT_BUDGET = 16 * 1024
+DESCRIPTION_BUDGET = 2 * 1024
+
+_FIELD_NAME = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+_HIDDEN_ELEMENTS = re.compile(
+    r'<(script|style|table|figure)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+_TAGS = re.compile(r'<[^>]*>')
+_WHITESPACE = re.compile(r'\s+', re.UNICODE)
+
+
+def strip_html(html, limit=DESCRIPTION_BUDGET):
+    '''Reduce comicvine html to plain text of at most limit bytes.
+
+    Tables and figures are dropped entirely as they hold cover lists and
+    image captions that are of no use in search.  Text is truncated at a
+    word boundary.
+    '''
+    if not html:
+        return u''
+    text = _HIDDEN_ELEMENTS.sub(' ', html)
+    text = _TAGS.sub(' ', text)
+    text = HTMLParser().unescape(text)
+    text = _WHITESPACE.sub(' ', text).strip()
+    return truncate(text, limit)
+
+def truncate(text, limit):
+    if len(text.encode('utf-8')) <= limit:
+        return text
+    # Cut the encoded text once, dropping any partial trailing character.
+    cut = text.encode('utf-8')[:limit].decode('utf-8', 'ignore')
+    if not text[len(cut)].isspace() and ' ' in cut:
+        # The cut fell inside a word
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip()
+
+def field_size(field):
+    value = field.value
+    if value is None:
+        value = u''
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return len(field.name) + len(value)
+
+def document_size(document):
+    return sum(field_size(field) for field in document.fields)
+
+def role_names(role):
+    '''Split a comicvine role string into valid field names.
+
+    Comicvine credits people with a comma separated list of roles, eg.
+    "writer, cover".  Roles which are not valid field names fall back to
+    'person'.
+    '''
+    names = []
+    for name in (role or '').split(','):
+        name = name.strip().replace(' ', '_')
+        if not _FIELD_NAME.match(name):
+            name = 'person'
+        if name not in names:
+            names.append(name)
+    return names or ['person']
+
+
+class DocumentBuilder(object):
+    '''Accumulate prioritised search fields for a document.
+
+    Duplicate fields are discarded as they are added.  When the document
+    is built fields are included in priority order until the budget is
+    used, with any remaining fields dropped.
+    '''
+    def __init__(self, doc_id, budget=DOCUMENT_BUDGET,
+                 description_budget=DESCRIPTION_BUDGET):
+        self.doc_id = doc_id
+        self.budget = budget
+        self.description_budget = description_budget
+        self.size = 0
+        self.dropped = []
+        self._fields = []
+        self._seen = set()
+
+    def add(self, field, priority=PRIORITY_NORMAL):
+        signature = (field.name, field.value)
+        if signature in self._seen:
+            return
+        self._seen.add(signature)
+        self._fields.append((priority, len(self._fields), field))
+
+    def add_text(self, name, value, priority=PRIORITY_NORMAL):
+        if value:
+            field = search_api().TextField(name=name, value=value)
+            self.add(field, priority)
+
+    def add_number(self, name, value, priority=PRIORITY_NORMAL):
+        if value is not None:
+            field = search_api().NumberField(name=name, value=value)
+            self.add(field, priority)
+
+    def add_date(self, name, value, priority=PRIORITY_NORMAL):
+        if value:
+            field = search_api().DateField(name=name, value=value)
+            self.add(field, priority)
+
+    def add_description(self, html, priority=PRIORITY_LOW):
+        self.add_text(
+            'description', strip_html(html, self.description_budget),
+            priority)
+
+    def add_people(self, credits, priority=PRIORITY_NORMAL):
+        for person in credits or []:
+            name = person.get('name')
+            for role in role_names(person.get('role', 'person')):
+                self.add_text(role, name, priority)
+
+    def fields(self):
+        selected = []
+        self.size = 0
+        self.dropped = []
+        for priority, _, field in sorted(self._fields):
+            size = field_size(field)
+            if (priority == PRIORITY_REQUIRED or
+                    self.size + size <= self.budget):
+                selected.append(field)
+                self.size += size
+            else:
+                self.dropped.append(field.name)
+        return selected
+
+    def build(self):
+        document = search_api().Document(
+            doc_id=self.doc_id, fields=self.fields())
+        if self.dropped:
+            logging.info('Document %s over budget, dropped fields: %r',
+                         self.doc_id, self.dropped)
+        logging.info('Document %s: %d fields, %d bytes',
+                     self.doc_id, len(document.fields), self.size)
+        return document
+
+
+def search_api():
+    '''The search api module, imported on first use.
+
+    Importing it loads the search protocol buffers, which is wasted on
+    requests that never index anything.
+    '''
+    # pylint: disable=import-error
+    from google.appengine.api import search
+    return search
+
+def index_generation(index_name):
+    '''Current generation of an index for cache invalidation.
+
+    The generation is incremented once per successful put_documents
+    call, so documents written together invalidate cached queries once.
+    If the counter is evicted it restarts from the current time so
+    results cached under an earlier generation are never reused.
+    '''
+    generation = memcache.get(index_name, namespace='search_generation')
+    if generation is None:
+        memcache.add(index_name, int(time()), namespace='search_generation')
+        generation = memcache.get(index_name, namespace='search_generation')
+    return generation
+
+def invalidate(index_name):
+    memcache.incr(index_name, initial_value=int(time()),
+                  namespace='search_generation')
+
+def put_documents(index_name, document_list):
+    '''Put documents into an index and invalidate its cached queries.
+
+    Callers which build documents with index_document(batch=True) should
+    write them here, so the index generation is bumped once for the
+    whole list.  The generation is only bumped if the put succeeds.
+    '''
+    search = search_api()
+    results = []
+    try:
+        index = search.Index(name=index_name)
+        results = index.put(document_list)
+    except search.Error as error:
+        logging.exception('Put failed: %r', error)
+    else:
+        invalidate(index_name)
+    return results
+
+def put_document(index_name, document):
+    return put_documents(index_name, [document])
@@ -0,0 +1,225 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Bounded in process cache of read mostly catalog entities.
+
+The ndb context cache only lasts for a request, so entities such as the
+volume and publisher of popular issues are fetched from memcache on every
+request.  This cache keeps them in the instance for a short time.
+
+Entities are held as encoded protocol buffers, so callers always get a
+private copy and the memory used is known.  Each entity has a generation
+counter in memcache which is incremented after it is written through
+the put and delete functions of this module.  A cached entry is
+revalidated against its counter at most once every GENERATION_CHECK
+seconds, with a single get_multi for all the entries being read.  That
+bounds how long another instance can serve a stale entity, and a put of
+one entity does not affect any other entry.
+
+The models write every kind through this module, not only the cached
+kinds, so a kind added to CACHED_KINDS has no writes which bypass the
+invalidation.  Writes of other kinds cost nothing extra.
+
+Issues are cached as full entities rather than projections.  Callers
+such as the loader hand them to code which reads the json and may put
+them back, which a projection entity does not support.  The stored json
+is trimmed (see payloads) so full issues stay small.
+'''
+from collections import OrderedDict
+import threading
+from time import time
+
+from google.appengine.api import memcache # pylint: disable=import-error
+from google.appengine.datastore import entity_pb # pylint: disable=import-error
+from google.appengine.ext import ndb # pylint: disable=import-error
+
+CACHED_KINDS = ['Issue', 'Publisher', 'StoryArc', 'Volume']
+MAX_ENTRIES = 2000
+MAX_BYTES = 16 * 1024 * 1024
+ENTRY_TTL = 300
+GENERATION_CHECK = 5
+
+
+def generation_key(key):
+    return key.urlsafe()
+
+def generations(keys):
+    '''Current generation of each key, 0 if it has never been put.'''
+    keys = [key for key in keys if key.kind() in CACHED_KINDS]
+    if not keys:
+        return {}
+    names = dict((generation_key(key), key) for key in keys)
+    stored = memcache.get_multi(names.keys(), namespace='entity_generation')
+    return dict((key, stored.get(name, 0)) for name, key in names.items())
+
+
+class EntityCache(object):
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES,
+                 ttl=ENTRY_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key: [expires, generation, checked until, data]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._adapter = ndb.ModelAdapter()
+
+    def get_multi(self, keys):
+        '''Cached copies of the entities for keys.
+
+        Returns ({key: entity} for hits, {key: generation} for misses).
+        The generations of misses should be passed to set once they are
+        loaded.
+        '''
+        keys = [key for key in keys if key.kind() in CACHED_KINDS]
+        now = time()
+        found = {}
+        unchecked = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None or entry[0] < now:
+                    continue
+                found[key] = entry
+                if entry[2] < now:
+                    unchecked.append(key)
+        current = generations(
+            [key for key in keys if key not in found or key in unchecked])
+        hits = {}
+        with self._lock:
+            for key, entry in found.items():
+                if key in current:
+                    if current[key] != entry[1]:
+                        self._remove(key)
+                        continue
+                    entry[2] = now + GENERATION_CHECK
+                # Move to the end so the least recently used is evicted
+                del self._entries[key]
+                self._entries[key] = entry
+                hits[key] = entry[3]
+            self.hits += len(hits)
+            self.misses += len(keys) - len(hits)
+        misses = dict(
+            (key, generation) for key, generation in current.items()
+            if key not in hits)
+        return dict(
+            (key, self._adapter.pb_to_entity(entity_pb.EntityProto(data)))
+            for key, data in hits.items()), misses
+
+    def get(self, key):
+        hits, _ = self.get_multi([key])
+        return hits.get(key)
+
+    def set(self, entity, generation):
+        '''Cache an entity.
+
+        generation must be read before the entity was loaded, so that an
+        entity changed while it was being loaded is never cached as
+        current.
+        '''
+        key = entity.key
+        if not key or key.kind() not in CACHED_KINDS:
+            return
+        data = self._adapter.entity_to_pb(entity).Encode()
+        now = time()
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = [
+                now + self.ttl, generation, now + GENERATION_CHECK, data]
+            self.bytes += len(data)
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def evict(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= len(entry[3])
+
+    def invalidate_multi(self, keys):
+        '''Drop entities here and bump their generations elsewhere.'''
+        keys = [key for key in keys if key and key.kind() in CACHED_KINDS]
+        if not keys:
+            return
+        for key in keys:
+            self.evict(key)
+        memcache.offset_multi(
+            dict((generation_key(key), 1) for key in keys),
+            namespace='entity_generation', initial_value=0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(1.0 * self.hits / lookups, 3) if lookups else 0,
+        }
+
+
+CACHE = EntityCache()
+
+
+def get(key):
+    '''Entity for key from the cache, falling back to the datastore.'''
+    hits, misses = CACHE.get_multi([key])
+    if key in hits:
+        return hits[key]
+    entity = key.get()
+    if entity and key in misses:
+        CACHE.set(entity, misses[key])
+    return entity
+
+def invalidate(keys):
+    '''Invalidate keys once the current transaction, if any, commits.
+
+    Invalidating before the commit would let another instance cache the
+    old entity under the new generation.
+    '''
+    keys = [key for key in keys if key and key.kind() in CACHED_KINDS]
+    if keys:
+        ndb.get_context().call_on_commit(
+            lambda: CACHE.invalidate_multi(keys))
+
+def put_multi(entities):
+    '''ndb.put_multi followed by one invalidation of the written keys.'''
+    keys = ndb.put_multi(entities)
+    invalidate(keys)
+    return keys
+
+def put(entity):
+    return put_multi([entity])[0]
+
+@ndb.tasklet
+def put_multi_async(entities):
+    keys = yield ndb.put_multi_async(entities)
+    invalidate(keys)
+    raise ndb.Return(keys)
+
+@ndb.tasklet
+def put_async(entity):
+    keys = yield put_multi_async([entity])
+    raise ndb.Return(keys[0])
+
+def delete_multi(keys):
+    ndb.delete_multi(keys)
+    invalidate(keys)
+
+def stats():
+    return CACHE.stats()
@@ -1,11 +1,11 @@
 # Copyright 2013 Russell Heilling
 # pylint: disable=missing-docstring
 from datetime import datetime, date
-from dateutil.parser import parse as parse_date
 import logging
-import re
+from time import time
 
-from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.model import BlobProperty
 from google.appengine.ext.ndb.model import BooleanProperty
@@ -18,9 +18,22 @@ from google.appengine.ext.ndb.model import StringProperty
 
 from pulldb.models import base
 from pulldb.models import arcs
+from pulldb.models import documents
+from pulldb.models import entity_cache
+from pulldb.models import loader
+from pulldb.models import migrations
+from pulldb.models import payloads
+from pulldb.models import shards
 from pulldb.models import volumes
+from pulldb.models.migrations import LEGACY_MIGRATION
 from pulldb.models.properties import ImageProperty
 
+LEGACY_DEADLINE = 30
+# Handler of tasks queued by deferred
+DEFERRED_URL = '/_ah/queue/deferred'
+# Migration progress shard of the final walk over all issues
+LEGACY_VERIFY = -2
+
 class NoSuchIssue(base.PullDBModelException):
     pass
 
@@ -60,12 +73,20 @@ class Issue(ndb.Model):
             'indexed', 'name', 'shard',
         ]
 
-    def apply_changes(self, issue_data):
-        if self.json:
-            merged_data = self.json
-            merged_data.update(issue_data)
-            self.json = merged_data
-            issue_data = merged_data
+    def _pre_put_hook(self):
+        shards.assign_shard(self)
+
+    def apply_changes(self, issue_data, resolve=True):
+        '''Merge ComicVine issue data into the issue.
+
+        With resolve the volume and story arcs are looked up, creating
+        missing arcs from ComicVine.  Otherwise their keys are built from
+        the ids in issue_data.
+        '''
+        merged_data = self.json or {}
+        merged_data.update(issue_data)
+        self.json = payloads.trim_payload('Issue', merged_data)
+        issue_data = merged_data
         try:
             self.name = '%s %s' % (
                 issue_data['volume']['name'],
@@ -78,19 +99,25 @@ class Issue(ndb.Model):
         self.title = issue_data.get('name')
         self.issue_number = issue_data.get('issue_number', '')
         self.site_detail_url = issue_data.get('site_detail_url')
-        volume_key = volumes.volume_key(issue_data['volume'], create=False)
+        if resolve:
+            volume_key = volumes.volume_key(issue_data['volume'], create=False)
+        else:
+            volume_key = ndb.Key('Volume', str(issue_data['volume']['id']))
         if volume_key not in self.collection:
             self.collection.append(volume_key)
         story_arcs = issue_data.get('story_arc_credits', [])
         for arc in story_arcs:
-            arc_key = arcs.arc_key(arc, create=True)
+            if resolve:
+                arc_key = arcs.arc_key(arc, create=True)
+            else:
+                arc_key = ndb.Key('StoryArc', str(arc['id']))
             if arc_key not in self.collection:
                 self.collection.append(arc_key)
         pubdate = None
         if issue_data.get('store_date'):
-            pubdate = parse_date(issue_data['store_date'])
+            pubdate = base.parse_date(issue_data['store_date'])
         elif issue_data.get('cover_date'):
-            pubdate = parse_date(issue_data['cover_date'])
+            pubdate = base.parse_date(issue_data['cover_date'])
         if isinstance(pubdate, date):
             self.pubdate = pubdate
         try:
@@ -98,91 +125,61 @@ class Issue(ndb.Model):
         except (KeyError, TypeError):
             self.image = None
         if issue_data.get('date_last_updated'):
-            last_update = parse_date(issue_data['date_last_updated'])
+            last_update = base.parse_date(issue_data['date_last_updated'])
         else:
             last_update = datetime.now
         self.last_updated = last_update
         self.indexed = False
 
-    def extract_search_fields(self):
-        document_fields = []
-        contributors = self.json.get('person_credits')
-        if contributors:
-            for person in contributors:
-                if re.match(r'^[A-Za-z][A-Za-z0-9_]*$', person['role']):
-                    role = person['role']
-                else:
-                    role = 'person'
-                document_fields.append(
-                    search.TextField(
-                        name=role, value=person['name']
-                    )
-                )
-        description = self.json.get('description')
-        if description:
-            document_fields.append(
-                search.HtmlField(name='description', value=description)
-            )
+    def extract_search_fields(self, document=None):
+        '''Add the fields held in the issue json to a search document.
+
+        Returns the fields of the document selected within its budget.
+        When a builder is passed these are all of its fields, including
+        any added by the caller, not only those added here.
+        '''
+        if not document:
+            document = documents.DocumentBuilder(self.key.id())
+        document.add_people(self.json.get('person_credits'))
+        document.add_description(self.json.get('description'))
         volume_name = self.json.get('volume', {}).get('name')
-        if volume_name:
-            document_fields.append(
-                search.TextField(name='volume', value=volume_name)
-            )
+        document.add_text('volume', volume_name, documents.PRIORITY_HIGH)
         if not self.name:
-            document_fields.append(
-                search.TextField(
-                    name='name', value='%s %s' % (
-                        self.json.get('volume', {}).get('name'),
-                        self.issue_number,
-                    )
-                )
-            )
+            document.add_text(
+                'name', '%s %s' % (volume_name, self.issue_number),
+                documents.PRIORITY_REQUIRED)
         if not self.volume:
             volume_id = self.json.get('volume', {}).get('id')
             if volume_id:
-                document_fields.append(
-                    search.NumberField(name='volume_id', value=int(volume_id))
-                )
-        return document_fields
+                document.add_number('volume_id', int(volume_id),
+                                    documents.PRIORITY_REQUIRED)
+        return document.fields()
 
     def index_document(self, batch=False):
-        document_fields = [
-            search.TextField(name='title', value=self.title),
-            search.TextField(name='issue_number', value=self.issue_number),
-            search.NumberField(name='issue_id', value=self.identifier),
-        ]
+        document = documents.DocumentBuilder(self.key.id())
+        document.add_number('issue_id', self.identifier,
+                            documents.PRIORITY_REQUIRED)
+        document.add_text('title', self.title, documents.PRIORITY_HIGH)
+        document.add_text('issue_number', self.issue_number,
+                          documents.PRIORITY_HIGH)
 
         if isinstance(self.pubdate, date):
-            document_fields.append(
-                search.DateField(name='pubdate', value=self.pubdate)
-            )
+            document.add_date('pubdate', self.pubdate,
+                              documents.PRIORITY_HIGH)
 
         if self.json:
-            document_fields.extend(self.extract_search_fields())
+            self.extract_search_fields(document)
 
-        if self.name:
-            document_fields.append(
-                search.TextField(name='name', value=self.name)
-            )
+        document.add_text('name', self.name, documents.PRIORITY_REQUIRED)
 
         if self.volume:
-            document_fields.append(
-                search.NumberField(
-                    name='volume_id', value=int(self.volume.id())
-                )
-            )
+            document.add_number('volume_id', int(self.volume.id()),
+                                documents.PRIORITY_REQUIRED)
 
-        issue_doc = search.Document(
-            doc_id=self.key.id(),
-            fields=document_fields,
-        )
+        issue_doc = document.build()
         if batch:
             return issue_doc
-        try:
-            index = search.Index(name="issues")
-            index.put(issue_doc)
-        except search.Error as error:
-            logging.exception('Put failed: %r', error)
+        documents.put_document(documents.ISSUE_INDEX, issue_doc)
 
     def has_updates(self, new_data):
         issue_data = self.json or {}
@@ -190,7 +187,7 @@ class Issue(ndb.Model):
 
         new_data_date = new_data.get('date_last_updated')
         if new_data_date:
-            last_update = parse_date(new_data_date)
+            last_update = base.parse_date(new_data_date)
         else:
             last_update = datetime.min
 
@@ -205,34 +202,253 @@ class Issue(ndb.Model):
         return updates, last_update
 
 def check_collection_changes(issue, issue_data):
+    '''True if issue_data refers to collections the issue is not in.
+
+    Arc keys are built from their ids, so the check never reads or
+    creates arcs.
+    '''
     changed = False
     if issue.volume not in issue.collection:
         changed = True
     for story_arc in issue_data.get('story_arc_credits', []):
-        arc_key = arcs.arc_key(story_arc, create=True)
+        arc_key = ndb.Key('StoryArc', str(story_arc['id']))
         if arc_key not in issue.collection:
             changed = True
     return changed
 
+def as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def issue_snapshot(issue):
+    '''Values of an issue which are copied into derived entities.'''
+    return {
+        'collection': list(issue.collection),
+        'name': issue.name,
+        'pubdate': as_date(issue.pubdate),
+        'volume': issue.volume,
+    }
+
+def deferred_task(function, *args):
+    '''A task which runs function(*args), as deferred.defer would.'''
+    return taskqueue.Task(
+        payload=deferred.serialize(function, *args), url=DEFERRED_URL,
+        headers={'Content-Type': 'application/octet-stream'})
+
+def queue_issue_updates(issue, previous=None):
+    '''Queue the updates of the entities derived from an issue.
+
+    Called once the issue has been put.  previous is the issue_snapshot
+    taken before changes were applied, or None if the issue is new.  One
+    task is queued for each kind of derived entity which needs updating,
+    so a failed update is retried on its own.  The tasks are added with
+    a single call.
+    '''
+    current = issue_snapshot(issue)
+    if current == previous:
+        return
+    tasks = [
+        deferred_task(function, *args) for function, args in derived_updates(
+            issue.key, issue.issue_number, current, previous)]
+    taskqueue.Queue().add(tasks)
+
+def derived_updates(issue_key, issue_number, current, previous=None):
+    '''Updates of streams, releases, statistics, arcs and pulls of an issue.
+
+    current and previous are issue_snapshot values, previous is None for
+    a new issue.  Returns a list of (function, args) for the updates
+    needed.  Each update is idempotent so its task may be retried.
+    '''
+    # The derived kinds are only needed when an issue is written, and
+    # pulls depends on this module, so they are imported on first use.
+    from pulldb.models import memberships
+    from pulldb.models import pulls
+    from pulldb.models import releases
+    from pulldb.models import statistics
+    from pulldb.models import streams
+    updates = []
+    new = previous is None
+    previous = previous or {}
+    if current['pubdate'] and current['pubdate'] != previous.get('pubdate'):
+        updates.append((streams.update_issue_streams, (
+            issue_key, current['volume'], current['pubdate'],
+            previous.get('pubdate'))))
+    if current['pubdate'] and current['volume'] and (
+            current['pubdate'] != previous.get('pubdate') or
+            current['volume'] != previous.get('volume')):
+        updates.append((releases.record_release, (
+            issue_key, current['volume'], current['pubdate'],
+            previous.get('volume'), previous.get('pubdate'))))
+    if (current['pubdate'] != previous.get('pubdate') or
+            current['collection'] != previous.get('collection')):
+        collections = set(current['collection'])
+        collections.update(previous.get('collection', []))
+        if current['volume']:
+            collections.add(current['volume'])
+        updates.append((statistics.queue_update, (list(collections),)))
+    arcs_now = memberships.arc_keys(current['collection'])
+    arcs_before = memberships.arc_keys(previous.get('collection'))
+    if arcs_now != arcs_before or (
+            arcs_now and current['pubdate'] != previous.get('pubdate')):
+        updates.append((memberships.update_issue_arcs, (
+            issue_key, arcs_now,
+            [key for key in arcs_before if key not in arcs_now],
+            current['pubdate'], issue_number)))
+    if new:
+        updates.append((pulls.queue_new_issue, (issue_key, current)))
+    else:
+        updates.append((pulls.queue_issue_changes, (issue_key,)))
+    return updates
+
+@ndb.tasklet
+def put_issue_async(issue, previous=None):
+    '''Put an issue and then queue the update of its derived entities.'''
+    key = yield entity_cache.put_async(issue)
+    queue_issue_updates(issue, previous)
+    raise ndb.Return(key)
+
+def convert_legacy(key, legacy):
+    '''Build a top level issue from a legacy volume parented issue.'''
+    issue = Issue(
+        key=key,
+        identifier=int(key.id()),
+        volume=legacy.volume,
+        last_updated=datetime.min,
+        name=legacy.name,
+        shard=legacy.shard,
+    )
+    if legacy.pubdate:
+        issue.pubdate = legacy.pubdate
+    if legacy.json:
+        # References are kept as stored, so no ComicVine call is made
+        issue.apply_changes(legacy.json, resolve=False)
+    return issue
+
 # TODO(rgh): Temporary lookup of old style pull key during transition
 def check_legacy(key, volume_key):
-    issue = key.get()
+    if migrations.is_complete(LEGACY_MIGRATION):
+        return
+    issue = entity_cache.get(key)
     if not issue:
         legacy = ndb.Key(Issue, key.id(), parent=volume_key).get()
         if legacy:
-            issue = Issue(
-                key=key,
-                identifier=key.id(),
-                volume=legacy.volume,
-                last_updated=datetime.min,
-                name=legacy.name,
-                shard=legacy.shard,
-            )
-            if legacy.pubdate:
-                issue.pubdate = legacy.pubdate
-            if legacy.json:
-                issue.apply_changes(legacy.json)
-            issue.put()
+            issue = convert_legacy(key, legacy)
+            entity_cache.put(issue)
+
+def start_legacy_migration():
+    '''Queue conversion of all legacy issues, one task per shard.
+
+    A final verification walk (LEGACY_VERIFY) runs once every shard is
+    done, so check_legacy only becomes a no-op after it.
+    '''
+    shard_list = [shards.UNASSIGNED] + range(shards.shard_count())
+    migrations.start(LEGACY_MIGRATION, shard_list + [LEGACY_VERIFY])
+    for shard in shard_list:
+        deferred.defer(migrate_legacy_issues, shard)
+
+def convert_legacy_keys(legacy_keys):
+    '''Convert the legacy issues which have no top level replacement.
+
+    Returns the number of issues converted.
+    '''
+    new_keys = [ndb.Key(Issue, key.id()) for key in legacy_keys]
+    missing = [
+        legacy_key for legacy_key, issue in zip(
+            legacy_keys, ndb.get_multi(new_keys)) if not issue]
+    if not missing:
+        return 0
+    legacy_issues = [legacy for legacy in ndb.get_multi(missing) if legacy]
+    converted = [
+        convert_legacy(ndb.Key(Issue, legacy.key.id()), legacy)
+        for legacy in legacy_issues]
+    entity_cache.put_multi(converted)
+    return len(converted)
+
+def migrate_legacy_issues(shard, cursor=None, batch_size=100,
+                          deadline=LEGACY_DEADLINE):
+    '''Convert the legacy issues in a shard.
+
+    Walks the issue keys in the shard by cursor and converts volume
+    parented issues which have no top level replacement.  Progress is
+    recorded after each batch and the work continues in a new task when
+    the deadline is hit.  The last shard to finish queues the
+    verification walk.
+    '''
+    start = time()
+    query = Issue.query(Issue.shard == shard)
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+    more = True
+    while more and time() - start < deadline:
+        start_cursor = cursor.urlsafe() if cursor else None
+        keys, cursor, more = query.fetch_page(
+            batch_size, keys_only=True, start_cursor=cursor)
+        converted = convert_legacy_keys([key for key in keys if key.parent()])
+        migrations.record_progress(
+            LEGACY_MIGRATION, shard, start_cursor=start_cursor,
+            cursor=cursor.urlsafe() if cursor else None,
+            processed=len(keys), converted=converted,
+            done=not (more and cursor))
+        logging.info('Converted %d/%d legacy issues in shard %d',
+                     converted, len(keys), shard)
+    if more and cursor:
+        deferred.defer(migrate_legacy_issues, shard, cursor=cursor.urlsafe(),
+                       batch_size=batch_size, deadline=deadline)
+    else:
+        queue_legacy_verification()
+
+def queue_legacy_verification():
+    '''Queue the verification walk once every shard is converted.'''
+    shard_list = [
+        progress.shard for progress in migrations.status(LEGACY_MIGRATION)]
+    if LEGACY_VERIFY not in shard_list:
+        return
+    # Progress is read by key as the status query may be stale
+    progress = dict(
+        (entity.shard, entity) for entity in ndb.get_multi([
+            migrations.progress_key(LEGACY_MIGRATION, shard)
+            for shard in shard_list]) if entity)
+    verify = progress.pop(LEGACY_VERIFY, None)
+    if not verify or verify.done or not all(
+            entity.done for entity in progress.values()):
+        return
+    name = 'legacy-issues-verify-%s' % verify.started.strftime(
+        '%Y%m%d%H%M%S%f')
+    try:
+        deferred.defer(verify_legacy_issues, _name=name)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+def verify_legacy_issues(cursor=None, batch_size=500,
+                         deadline=LEGACY_DEADLINE):
+    '''Walk all issue keys converting any legacy issue left behind.
+
+    Catches legacy issues which moved between shards during the shard
+    walks.  The migration is complete once this walk is done.
+    '''
+    start = time()
+    query = Issue.query()
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+    more = True
+    while more and time() - start < deadline:
+        start_cursor = cursor.urlsafe() if cursor else None
+        keys, cursor, more = query.fetch_page(
+            batch_size, keys_only=True, start_cursor=cursor)
+        converted = convert_legacy_keys([key for key in keys if key.parent()])
+        if converted:
+            logging.warn('Verification converted %d legacy issues',
+                         converted)
+        migrations.record_progress(
+            LEGACY_MIGRATION, LEGACY_VERIFY, start_cursor=start_cursor,
+            cursor=cursor.urlsafe() if cursor else None,
+            processed=len(keys), converted=converted,
+            done=not (more and cursor))
+    if more and cursor:
+        deferred.defer(verify_legacy_issues, cursor=cursor.urlsafe(),
+                       batch_size=batch_size, deadline=deadline)
 
 def issue_key(issue_data, volume_key=None, create=True, batch=False):
     # handle empty input gracefully
@@ -248,13 +464,15 @@ def issue_key(issue_data, volume_key=None, create=True, batch=False):
     else:
         issue_id = issue_data['id']
     key = ndb.Key(Issue, str(issue_id))
-    issue = key.get()
+    issue = entity_cache.get(key)
 
     if isinstance(issue_data, dict):
         updated = False
 
+        previous = None
         if issue:
             updated, last_update = issue.has_updates(issue_data)
+            previous = issue_snapshot(issue)
         elif create:
             volume_key = ndb.Key('Volume', str(issue_data['volume']['id']))
             issue = Issue(
@@ -274,15 +492,17 @@ def issue_key(issue_data, volume_key=None, create=True, batch=False):
                 'Saving issue updates for %s (last update at: %s)',
                 key.id(), last_update)
             if batch:
-                return issue.put_async()
-            issue.put()
+                return put_issue_async(issue, previous)
+            entity_cache.put(issue)
+            queue_issue_updates(issue, previous)
 
     if issue:
         return key
 
 @ndb.tasklet
 def issue_context(issue):
-    volume = yield issue.key.parent().get_async()
+    # Legacy issues are parented by their volume
+    volume = yield loader.load(issue.volume or issue.key.parent())
     raise ndb.Return({
         'issue': issue,
         'volume': volume,
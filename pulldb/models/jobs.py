@@ -0,0 +1,222 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Resumable batch jobs which walk a query in bounded slices.
+
+A job walks a query by cursor, one shard per task, processing entities in
+chunks and writing the results with put_multi.  When the deadline of a
+slice is reached the job queues its next slice with the cursor, so long
+running work never depends on finishing within a single request.
+Progress and throughput of each shard are recorded in the datastore.
+
+Jobs are registered by name:
+
+    @jobs.register
+    class Reindex(jobs.ChunkedJob):
+        name = 'reindex_volumes'
+        kind = 'Volume'
+
+        def process(self, entities):
+            ...
+            return changed_entities
+
+    jobs.start('reindex_volumes')
+'''
+import abc
+import logging
+from time import time
+
+from google.appengine.ext import deferred # pylint: disable=import-error
+from google.appengine.ext import ndb # pylint: disable=import-error
+
+from pulldb.models import entity_cache
+from pulldb.models import shards
+
+JOBS = {}
+
+
+class JobProgress(ndb.Model):
+    '''Progress of one shard of a job run.
+
+    Keyed by job name and shard (eg. reindex_volumes:3).  Starting a job
+    resets the progress of all its shards.
+    '''
+    # pylint: disable=no-init,too-few-public-methods
+    chunks = ndb.IntegerProperty(default=0)
+    cursor = ndb.StringProperty(indexed=False)
+    done = ndb.BooleanProperty(default=False)
+    elapsed = ndb.FloatProperty(default=0.0)
+    name = ndb.StringProperty()
+    processed = ndb.IntegerProperty(default=0)
+    run = ndb.IntegerProperty()
+    shard = ndb.IntegerProperty()
+    slices = ndb.IntegerProperty(default=0)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    throughput = ndb.FloatProperty(default=0.0)
+    updated = ndb.DateTimeProperty(auto_now=True)
+    written = ndb.IntegerProperty(default=0)
+
+
+class ChunkedJob(object):
+    '''Base class for resumable jobs.
+
+    Subclasses set name and kind and implement process, which is passed a
+    chunk of entities and returns the entities to write.  query may be
+    overridden to walk something other than every entity of kind in the
+    shard.
+    '''
+    __metaclass__ = abc.ABCMeta
+    name = None
+    kind = None
+    # Entities fetched per page and passed to process per chunk
+    batch_size = 100
+    chunk_size = 100
+    # Seconds of work done in a slice before continuing in a new task
+    deadline = 30
+    sharded = True
+    queue = 'default'
+
+    def __init__(self, **params):
+        self.params = params
+
+    def shard_list(self):
+        if self.sharded:
+            return [shards.UNASSIGNED] + range(shards.shard_count())
+        return [None]
+
+    def query(self, shard):
+        query = ndb.Query(kind=self.kind)
+        if shard is not None:
+            query = query.filter(ndb.GenericProperty('shard') == shard)
+        return query
+
+    @abc.abstractmethod
+    def process(self, entities):
+        '''Return the entities of a chunk which need to be written.'''
+
+    def run_slice(self, shard, cursor=None):
+        '''Process a shard until it is exhausted or the deadline passes.
+
+        Returns the cursor to continue from, or None when done.
+        '''
+        start = time()
+        query = self.query(shard)
+        start_cursor = cursor
+        if cursor:
+            cursor = ndb.Cursor(urlsafe=cursor)
+        processed = written = chunks = 0
+        more = True
+        while more and time() - start < self.deadline:
+            batch, cursor, more = query.fetch_page(
+                self.batch_size, start_cursor=cursor)
+            for offset in range(0, len(batch), self.chunk_size):
+                changed = self.process(
+                    batch[offset:offset + self.chunk_size]) or []
+                if changed:
+                    entity_cache.put_multi(changed)
+                written += len(changed)
+                chunks += 1
+            processed += len(batch)
+        if not (more and cursor):
+            cursor = None
+        record_progress(
+            self.name, shard, self.params.get('run'),
+            start_cursor=start_cursor,
+            cursor=cursor.urlsafe() if cursor else None,
+            processed=processed, written=written, chunks=chunks,
+            elapsed=time() - start, done=cursor is None)
+        logging.info('Job %s shard %r: processed %d, wrote %d in %.1fs',
+                     self.name, shard, processed, written, time() - start)
+        if cursor:
+            return cursor.urlsafe()
+
+
+def register(job_class):
+    JOBS[job_class.name] = job_class
+    return job_class
+
+def progress_key(name, shard):
+    return ndb.Key(JobProgress, '%s:%s' % (name, shard))
+
+@ndb.transactional
+def record_progress(name, shard, run, start_cursor=None, cursor=None,
+                    processed=0, written=0, chunks=0, elapsed=0.0,
+                    done=False):
+    '''Add the work of a slice to the progress of its shard.
+
+    start_cursor is the cursor the slice started from.  The progress is
+    only updated if it ends at that cursor, so a slice which is retried
+    after its progress was recorded is not counted twice.
+    '''
+    # pylint: disable=too-many-arguments
+    progress = progress_key(name, shard).get()
+    if progress is None or progress.run != run:
+        progress = JobProgress(
+            key=progress_key(name, shard), name=name, run=run, shard=shard)
+    elif progress.done or progress.cursor != start_cursor:
+        logging.info('Progress of job %s shard %r already recorded',
+                     name, shard)
+        return progress
+    progress.cursor = cursor
+    progress.processed += processed
+    progress.written += written
+    progress.chunks += chunks
+    progress.elapsed += elapsed
+    progress.slices += 1
+    progress.done = done
+    if progress.elapsed:
+        progress.throughput = progress.processed / progress.elapsed
+    entity_cache.put(progress)
+    return progress
+
+def start(name, **params):
+    '''Reset the progress of a job and queue one task per shard.
+
+    Each run is given an id allocated by the datastore, so runs started
+    within the same second are kept apart.
+    The job class itself is passed to the tasks, so the module defining
+    it is imported wherever a slice runs.
+    '''
+    params['run'], _ = JobProgress.allocate_ids(1)
+    job_class = JOBS[name]
+    job = job_class(**params)
+    shard_list = job.shard_list()
+    entity_cache.put_multi([
+        JobProgress(key=progress_key(name, shard), name=name,
+                    run=params['run'], shard=shard)
+        for shard in shard_list
+    ])
+    for shard in shard_list:
+        deferred.defer(run_job, job_class, shard, params, _queue=job.queue)
+    return shard_list
+
+def run_job(job_class, shard, params, cursor=None):
+    job = job_class(**params)
+    cursor = job.run_slice(shard, cursor)
+    if cursor:
+        deferred.defer(run_job, job_class, shard, params, cursor=cursor,
+                       _queue=job.queue)
+
+def status(name):
+    '''Progress of each shard and the totals of the latest run.'''
+    progress = JobProgress.query(JobProgress.name == name).fetch()
+    if progress:
+        # Shards dropped since an earlier run keep their old progress
+        latest = max(progress, key=lambda shard: shard.started).run
+        progress = [shard for shard in progress if shard.run == latest]
+    processed = sum(shard.processed for shard in progress)
+    elapsed = sum(shard.elapsed for shard in progress)
+    return {
+        'name': name,
+        'done': bool(progress) and all(shard.done for shard in progress),
+        'processed': processed,
+        'written': sum(shard.written for shard in progress),
+        'throughput': processed / elapsed if elapsed else 0.0,
+        'shards': [{
+            'shard': shard.shard,
+            'done': shard.done,
+            'processed': shard.processed,
+            'written': shard.written,
+            'slices': shard.slices,
+            'throughput': round(shard.throughput, 2),
+        } for shard in sorted(progress, key=lambda shard: shard.shard)],
+    }
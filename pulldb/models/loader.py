@@ -0,0 +1,113 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Request scoped batching of entity loads.
+
+Tasklets which load keys through the loader in the same event loop tick
+share a single get_multi.  Each key is loaded at most once per request,
+so related entities such as the publisher of many volumes are fetched
+once no matter how many contexts ask for them.  Catalog entities are
+served from the process level entity cache where possible.
+'''
+import logging
+
+from google.appengine.ext import ndb # pylint: disable=import-error
+from google.appengine.ext.ndb import eventloop # pylint: disable=import-error
+from google.appengine.ext.ndb import tasklets # pylint: disable=import-error
+
+from pulldb.models import entity_cache
+
+
+class Loader(object):
+    def __init__(self):
+        self.batches = 0
+        self.requested = 0
+        self._futures = {}
+        self._pending = []
+
+    def load(self, key):
+        '''Return a future for the entity with key.'''
+        self.requested += 1
+        if key is None:
+            future = tasklets.Future('load None')
+            future.set_result(None)
+            return future
+        future = self._futures.get(key)
+        if future is None:
+            future = tasklets.Future('load %r' % (key,))
+            self._futures[key] = future
+            if not self._pending:
+                # Dispatch after the tasklets already queued have run
+                eventloop.queue_call(None, self._dispatch)
+            self._pending.append(key)
+        return future
+
+    def load_multi(self, keys):
+        return [self.load(key) for key in keys]
+
+    def prime(self, entity):
+        '''Seed the loader with an entity loaded by other means.'''
+        if entity.key not in self._futures:
+            future = tasklets.Future('prime %r' % (entity.key,))
+            future.set_result(entity)
+            self._futures[entity.key] = future
+
+    def clear(self, key=None):
+        if key:
+            self._futures.pop(key, None)
+        else:
+            self._futures.clear()
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, []
+        hits, generations = entity_cache.CACHE.get_multi(pending)
+        keys = []
+        for key in pending:
+            if key not in hits:
+                keys.append(key)
+                continue
+            loaded = self._futures.get(key)
+            if loaded is not None and not loaded.done():
+                loaded.set_result(hits[key])
+        if not keys:
+            return
+        self.batches += 1
+        logging.debug('Loading batch of %d keys', len(keys))
+        for key, future in zip(keys, ndb.get_multi_async(keys)):
+            future.add_callback(
+                self._resolve, key, future, generations.get(key))
+
+    def _resolve(self, key, future, generation=None):
+        loaded = self._futures.get(key)
+        if loaded is None or loaded.done():
+            return
+        error = future.get_exception()
+        if error:
+            # Don't memoise failures, a later load may succeed
+            self._futures.pop(key, None)
+            loaded.set_exception(error, future.get_traceback())
+        else:
+            entity = future.get_result()
+            if entity and generation is not None:
+                entity_cache.CACHE.set(entity, generation)
+            loaded.set_result(entity)
+
+
+def loader():
+    '''Loader for the current request.
+
+    The loader is held on the ndb context, which is replaced for each
+    request.
+    '''
+    context = ndb.get_context()
+    request_loader = getattr(context, '_pulldb_loader', None)
+    if request_loader is None:
+        request_loader = Loader()
+        # pylint: disable=protected-access
+        context._pulldb_loader = request_loader
+    return request_loader
+
+def load(key):
+    return loader().load(key)
+
+def load_multi(keys):
+    return loader().load_multi(keys)
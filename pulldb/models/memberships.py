@@ -0,0 +1,199 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Story arc membership in reading order.
+
+Each arc has an ArcMembership entity listing its issues ordered by
+pubdate and issue number, so a page of an arc is a slice of one entity
+followed by a get_multi of the issues on the page.  Memberships are
+updated as issues join or leave arcs, and the arc_membership job
+rebuilds them from Issue.collection.
+'''
+from datetime import date, datetime
+import logging
+
+from google.appengine.ext import ndb # pylint: disable=import-error
+
+from pulldb.models import entity_cache
+from pulldb.models import jobs
+from pulldb.models import migrations
+from pulldb.models.migrations import LEGACY_MIGRATION
+
+# Stored for issues without a pubdate, which are read last
+UNDATED = date.max
+PAGE_SIZE = 25
+
+
+class ArcMembership(ndb.Model):
+    '''Issues of a story arc in reading order.
+
+    Keyed by arc id.  issues, pubdates and issue_numbers are parallel
+    lists.
+    '''
+    # pylint: disable=no-init,too-few-public-methods
+    arc = ndb.KeyProperty(kind='StoryArc')
+    changed = ndb.DateTimeProperty(auto_now=True)
+    issue_numbers = ndb.StringProperty(repeated=True, indexed=False)
+    issues = ndb.KeyProperty(kind='Issue', repeated=True, indexed=False)
+    pubdates = ndb.DateProperty(repeated=True, indexed=False)
+
+    def entries(self):
+        return [
+            (issue_key, None if pubdate == UNDATED else pubdate, number)
+            for issue_key, pubdate, number in zip(
+                self.issues, self.pubdates, self.issue_numbers)]
+
+    def _set_entries(self, entries):
+        entries.sort(key=lambda entry: reading_order(*entry))
+        self.issues = [entry[0] for entry in entries]
+        self.pubdates = [entry[1] or UNDATED for entry in entries]
+        self.issue_numbers = [entry[2] for entry in entries]
+
+    def insert(self, issue_key, pubdate, issue_number):
+        entry = (issue_key, as_date(pubdate), issue_number or '')
+        entries = self.entries()
+        if entry in entries:
+            return False
+        entries = [item for item in entries if item[0] != issue_key]
+        entries.append(entry)
+        self._set_entries(entries)
+        return True
+
+    def remove(self, issue_key):
+        if issue_key not in self.issues:
+            return False
+        self._set_entries(
+            [entry for entry in self.entries() if entry[0] != issue_key])
+        return True
+
+
+def as_date(value):
+    if hasattr(value, 'date'):
+        return value.date()
+    return value
+
+def number_order(issue_number):
+    '''Sort key for issue numbers such as 1, 10, 1.5, 1/2 and 0.MU.'''
+    try:
+        return (float(issue_number), issue_number)
+    except (TypeError, ValueError):
+        return (float('inf'), issue_number or '')
+
+def reading_order(issue_key, pubdate, issue_number):
+    return (pubdate or UNDATED, number_order(issue_number), issue_key.id())
+
+def membership_key(arc_key):
+    return ndb.Key(ArcMembership, arc_key.id())
+
+def arc_keys(collection):
+    return [key for key in collection or [] if key.kind() == 'StoryArc']
+
+@ndb.transactional
+def update_membership(arc_key, issue_key, pubdate=None, issue_number=None,
+                      member=True):
+    key = membership_key(arc_key)
+    membership = key.get()
+    if not membership:
+        if not member:
+            return False
+        membership = ArcMembership(key=key, arc=arc_key)
+    if member:
+        changed = membership.insert(issue_key, pubdate, issue_number)
+    else:
+        changed = membership.remove(issue_key)
+    if changed:
+        entity_cache.put(membership)
+    return changed
+
+def update_issue_arcs(issue_key, arcs, removed, pubdate, issue_number):
+    '''Place an issue in its arcs and remove it from arcs it has left.'''
+    for arc_key in arcs:
+        update_membership(arc_key, issue_key, pubdate, issue_number)
+    for arc_key in removed:
+        update_membership(arc_key, issue_key, member=False)
+
+def arc_issues(arc_key, offset=0, limit=PAGE_SIZE):
+    '''A page of an arc in reading order.
+
+    Returns ([(issue key, pubdate, issue number)], next offset, total).
+    next offset is None on the last page.
+    '''
+    membership = membership_key(arc_key).get()
+    if not membership:
+        return [], None, 0
+    entries = membership.entries()
+    page = entries[offset:offset + limit]
+    next_offset = offset + limit
+    if next_offset >= len(entries):
+        next_offset = None
+    return page, next_offset, len(entries)
+
+def arc_issue_page(arc_key, offset=0, limit=PAGE_SIZE):
+    '''Like arc_issues but returns the issues on the page.'''
+    entries, next_offset, total = arc_issues(arc_key, offset, limit)
+    issues = ndb.get_multi([entry[0] for entry in entries])
+    return [issue for issue in issues if issue], next_offset, total
+
+def build_entries(arc_key):
+    '''Entries of an arc built from the issues which list it.
+
+    Until the legacy issue migration is complete a volume parented issue
+    is only used if it has no top level copy.  After it, volume parented
+    issues are skipped.
+    '''
+    legacy_done = migrations.is_complete(LEGACY_MIGRATION)
+    query = ndb.Query(kind='Issue').filter(
+        ndb.GenericProperty('collection') == arc_key)
+    entries = {}
+    for issue in query.iter():
+        if issue.key.parent() and (
+                legacy_done or issue.key.id() in entries):
+            continue
+        entries[issue.key.id()] = (
+            issue.key, as_date(issue.pubdate), issue.issue_number or '')
+    return entries.values()
+
+@ndb.transactional
+def rebuild_membership(arc_key, entries, started):
+    '''Replace the entries of a membership with rebuilt entries.
+
+    started is when the issues were read.  If update_membership changed
+    the membership since then, its entries are kept and only the issues
+    it does not hold are added.  Returns True if the membership changed.
+    '''
+    key = membership_key(arc_key)
+    membership = key.get()
+    if not membership:
+        membership = ArcMembership(key=key, arc=arc_key)
+    current = membership.entries()
+    if membership.changed and membership.changed > started:
+        held = set(entry[0] for entry in current)
+        entries = current + [
+            entry for entry in entries if entry[0] not in held]
+    membership._set_entries(list(entries)) # pylint: disable=protected-access
+    if membership.entries() == current:
+        return False
+    entity_cache.put(membership)
+    return True
+
+
+@jobs.register
+class RebuildMemberships(jobs.ChunkedJob):
+    '''Rebuild the membership of every arc from Issue.collection.
+
+    Each membership is written in its own transaction by
+    rebuild_membership, so nothing is left for the job to write.
+    '''
+    name = 'arc_membership'
+    kind = 'StoryArc'
+    batch_size = 20
+    chunk_size = 20
+
+    def process(self, entities):
+        changed = 0
+        for arc in entities:
+            started = datetime.utcnow()
+            if rebuild_membership(arc.key, build_entries(arc.key), started):
+                changed += 1
+        logging.info('Rebuilt membership of %d/%d arcs',
+                     changed, len(entities))
+        return []
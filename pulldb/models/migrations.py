@@ -0,0 +1,87 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+import logging
+
+from google.appengine.api import memcache # pylint: disable=import-error
+from google.appengine.ext import ndb # pylint: disable=import-error
+
+from pulldb.models import entity_cache
+
+# Conversion of volume parented issues to top level issues (see issues)
+LEGACY_MIGRATION = 'legacy_issues'
+
+_COMPLETE = set()
+
+
+class MigrationProgress(ndb.Model):
+    '''Progress of one shard of a data migration.
+
+    Keyed by migration name and shard (eg. legacy_issues:3).
+    '''
+    # pylint: disable=no-init,too-few-public-methods
+    converted = ndb.IntegerProperty(default=0)
+    cursor = ndb.StringProperty(indexed=False)
+    done = ndb.BooleanProperty(default=False)
+    name = ndb.StringProperty()
+    processed = ndb.IntegerProperty(default=0)
+    shard = ndb.IntegerProperty()
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+def progress_key(name, shard):
+    return ndb.Key(MigrationProgress, '%s:%d' % (name, shard))
+
+def start(name, shard_list):
+    '''Reset the progress of a migration for a set of shards.'''
+    entity_cache.put_multi([
+        MigrationProgress(key=progress_key(name, shard), name=name,
+                          shard=shard)
+        for shard in shard_list
+    ])
+    _COMPLETE.discard(name)
+    memcache.delete(name, namespace='migrations')
+
+@ndb.transactional
+def record_progress(name, shard, start_cursor=None, cursor=None,
+                    processed=0, converted=0, done=False):
+    '''Add the work of a batch to the progress of its shard.
+
+    start_cursor is the cursor the batch started from.  The progress is
+    only updated if it ends at that cursor, so a batch which is retried
+    after its progress was recorded is not counted twice.
+    '''
+    # pylint: disable=too-many-arguments
+    progress = progress_key(name, shard).get()
+    if progress is None:
+        progress = MigrationProgress(
+            key=progress_key(name, shard), name=name, shard=shard)
+    elif progress.done or progress.cursor != start_cursor:
+        logging.info('Progress of migration %s shard %d already recorded',
+                     name, shard)
+        return progress
+    progress.cursor = cursor
+    progress.processed += processed
+    progress.converted += converted
+    progress.done = done
+    entity_cache.put(progress)
+    return progress
+
+def status(name):
+    return MigrationProgress.query(MigrationProgress.name == name).fetch()
+
+def is_complete(name):
+    '''True once every shard of a started migration is done.
+
+    Completion is permanent so it is cached in process and in memcache.
+    '''
+    if name in _COMPLETE:
+        return True
+    complete = memcache.get(name, namespace='migrations')
+    if complete is None:
+        shards = status(name)
+        complete = bool(shards) and all(shard.done for shard in shards)
+        memcache.set(name, complete, 300, namespace='migrations')
+    if complete:
+        _COMPLETE.add(name)
+    return complete
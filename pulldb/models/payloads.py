@@ -0,0 +1,149 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Trimming of ComicVine payloads before they are stored in model json.
+
+ComicVine detail resources include large nested lists (every issue of a
+volume, character and location credits) which nothing reads back from
+the stored json.  Each model has a schema of the fields it retains.  A
+field maps to None to keep the value as is, or to a tuple of the keys
+kept from a nested dict or from each dict in a list.  Lists are capped
+at LIST_LIMITS entries.
+
+Entities stored before trimming are shrunk by the shrink_issues,
+shrink_arcs and shrink_volumes jobs.
+'''
+import json
+import logging
+
+from pulldb.models import jobs
+from pulldb.varz import current_varz
+
+REFERENCE = ('id', 'name')
+ISSUE_REFERENCE = ('id', 'name', 'issue_number')
+IMAGE = ('icon_url', 'medium_url', 'small_url', 'thumb_url', 'tiny_url')
+
+SCHEMAS = {
+    'Issue': {
+        'cover_date': None,
+        'date_last_updated': None,
+        'deck': None,
+        'description': None,
+        'id': None,
+        'image': IMAGE,
+        'issue_number': None,
+        'name': None,
+        'person_credits': ('id', 'name', 'role'),
+        'site_detail_url': None,
+        'store_date': None,
+        'story_arc_credits': REFERENCE,
+        'volume': REFERENCE,
+    },
+    'StoryArc': {
+        'aliases': None,
+        'count_of_issue_appearances': None,
+        'date_last_updated': None,
+        'deck': None,
+        'description': None,
+        'first_appeared_in_issue': ISSUE_REFERENCE,
+        'id': None,
+        'image': IMAGE,
+        'name': None,
+        'publisher': REFERENCE,
+        'site_detail_url': None,
+    },
+    'Volume': {
+        'count_of_issues': None,
+        'date_last_updated': None,
+        'deck': None,
+        'description': None,
+        'first_issue': ISSUE_REFERENCE,
+        'id': None,
+        'image': IMAGE,
+        'last_issue': ISSUE_REFERENCE,
+        'name': None,
+        'people': ('id', 'name', 'count'),
+        'publisher': REFERENCE,
+        'site_detail_url': None,
+        'start_year': None,
+    },
+}
+
+DEFAULT_LIST_LIMIT = 50
+LIST_LIMITS = {
+    'person_credits': 100,
+    'story_arc_credits': 20,
+}
+
+
+def payload_size(data):
+    return len(json.dumps(data)) if data else 0
+
+def trim_value(name, value, keys):
+    if keys is None:
+        return value
+    if isinstance(value, dict):
+        return dict((key, value[key]) for key in keys if key in value)
+    if isinstance(value, list):
+        limit = LIST_LIMITS.get(name, DEFAULT_LIST_LIMIT)
+        return [trim_value(name, item, keys) for item in value[:limit]]
+    return value
+
+def trim(kind, data):
+    '''Copy of data with only the fields in the schema for kind.'''
+    schema = SCHEMAS[kind]
+    return dict(
+        (name, trim_value(name, value, schema[name]))
+        for name, value in data.items() if name in schema)
+
+def trim_payload(kind, data):
+    '''Trim data for storage, recording the bytes received and retained.'''
+    trimmed = trim(kind, data)
+    varz = current_varz()
+    if varz is not None:
+        received = payload_size(data)
+        retained = payload_size(trimmed)
+        varz.payload_received = (varz.payload_received or 0) + received
+        varz.payload_retained = (varz.payload_retained or 0) + retained
+    return trimmed
+
+
+class ShrinkPayloads(jobs.ChunkedJob):
+    '''Trim the stored json of existing entities of kind.
+
+    Only entities whose json changes are written.
+    '''
+    batch_size = 200
+
+    def process(self, entities):
+        changed = []
+        before = after = 0
+        for entity in entities:
+            if not entity.json:
+                continue
+            trimmed = trim(self.kind, entity.json)
+            if trimmed != entity.json:
+                before += payload_size(entity.json)
+                after += payload_size(trimmed)
+                entity.json = trimmed
+                changed.append(entity)
+        logging.info('Shrinking %d/%d %s entities from %d to %d bytes',
+                     len(changed), len(entities), self.kind, before, after)
+        return changed
+
+
+@jobs.register
+class ShrinkIssues(ShrinkPayloads):
+    name = 'shrink_issues'
+    kind = 'Issue'
+
+
+@jobs.register
+class ShrinkStoryArcs(ShrinkPayloads):
+    name = 'shrink_arcs'
+    kind = 'StoryArc'
+
+
+@jobs.register
+class ShrinkVolumes(ShrinkPayloads):
+    name = 'shrink_volumes'
+    kind = 'Volume'
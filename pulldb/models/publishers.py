@@ -4,6 +4,7 @@ import logging
 from google.appengine.ext import ndb
 
 from pulldb.models import comicvine
+from pulldb.models import entity_cache
 from pulldb.models.properties import ImageProperty
 
 class NoSuchPublisher(Exception):
@@ -23,6 +24,15 @@ class Publisher(ndb.Model):
     def projection(cls):
         return [ 'identifier', 'name', 'image' ]
 
+def warm_cache(limit=1000):
+    '''Load publishers so they are in memcache for the next requests.
+
+    There are few publishers and most volumes refer to one, so loading
+    them during warmup saves a datastore get on many cold requests.
+    '''
+    keys = Publisher.query().fetch(limit, keys_only=True)
+    return len([publisher for publisher in ndb.get_multi(keys) if publisher])
+
 def publisher_key(publisher_data, create=True):
     if not publisher_data:
         message = 'Cannot lookup publisher for: %r' % publisher_data
@@ -39,10 +49,10 @@ def publisher_key(publisher_data, create=True):
     key = ndb.Key(Publisher, str(publisher_id))
 
     if isinstance(publisher_data, dict):
-        publisher = key.get()
+        publisher = entity_cache.get(key)
         if not publisher and create:
             if 'image' not in publisher_data:
-                cv = comicvine.Comicvine()
+                cv = comicvine.load()
                 publisher_data = cv.fetch_publisher(
                     publisher_id,
                     field_list='id,name,image',
@@ -55,6 +65,6 @@ def publisher_key(publisher_data, create=True):
             )
             if publisher_data.get('image'):
                 publisher.image=publisher_data['image'].get('tiny_url')
-            publisher.put()
+            entity_cache.put(publisher)
 
     return key
@@ -1,15 +1,25 @@
 # Copyright 2013 Russell Heilling
 from datetime import datetime
 import logging
+from time import time
 
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 from pulldb.models import base
+from pulldb.models import entity_cache
 from pulldb.models import issues
+from pulldb.models import shards
 from pulldb.models import streams
 from pulldb.models import subscriptions
 from pulldb.models import users
 
+# Pulls written per put_multi and seconds of work per fan out task
+FANOUT_BATCH = 200
+FANOUT_DEADLINE = 30
+# Subscribers or watchers read per query page for new issues
+NEW_ISSUE_BATCH = 1000
+
 class NoSuchPull(base.PullDBModelException):
     pass
 
@@ -36,6 +46,188 @@ class Pull(ndb.Model):
     volume = ndb.KeyProperty(kind='Volume')
     weight = ndb.FloatProperty(default=1.0)
 
+    def _pre_put_hook(self):
+        shards.assign_shard(self)
+
+def sync_pull(pull, values, publisher=None):
+    '''Copy denormalised issue values into a pull.
+
+    values is an issues.issue_snapshot.  Returns True if the pull changed.
+    '''
+    changed = False
+    for attribute in ['collection', 'name', 'pubdate', 'volume']:
+        value = values.get(attribute)
+        if value is not None and getattr(pull, attribute) != value:
+            setattr(pull, attribute, value)
+            changed = True
+    if publisher and pull.publisher != publisher:
+        pull.publisher = publisher
+        changed = True
+    return changed
+
+def queue_issue_changes(issue_key):
+    '''Queue the update of the pulls of a changed issue, one per shard.'''
+    for shard in [shards.UNASSIGNED] + range(shards.shard_count()):
+        deferred.defer(sync_issue_pulls, issue_key, shard)
+
+def sync_issue_pulls(issue_key, shard, cursor=None, publisher_key=None,
+                     batch_size=FANOUT_BATCH, deadline=FANOUT_DEADLINE):
+    '''Copy the current values of an issue into its pulls in a shard.
+
+    The issue is read when the task runs, so a task queued before a later
+    change never writes older values.  Pulls are found with a keys only
+    query and written in chunks with put_multi.  When the deadline is
+    reached the remaining work is queued from the query cursor, with the
+    publisher looked up by the first task.  Only changed pulls are
+    written so the task is safe to repeat.
+    '''
+    start = time()
+    issue = issue_key.get()
+    if not issue:
+        logging.warn('Issue %s removed before its pulls were updated',
+                     issue_key.id())
+        return
+    values = issues.issue_snapshot(issue)
+    if publisher_key is None and values.get('volume'):
+        volume = entity_cache.get(values['volume'])
+        if volume:
+            publisher_key = volume.publisher
+    query = Pull.query(Pull.issue == issue_key, Pull.shard == shard)
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+    written = 0
+    more = True
+    while more and time() - start < deadline:
+        keys, cursor, more = query.fetch_page(
+            batch_size, keys_only=True, start_cursor=cursor)
+        pulls = [pull for pull in ndb.get_multi(keys) if pull]
+        changed = [
+            pull for pull in pulls if sync_pull(pull, values, publisher_key)]
+        if changed:
+            entity_cache.put_multi(changed)
+            written += len(changed)
+    logging.info('Updated %d pulls for issue %s in shard %d',
+                 written, issue_key.id(), shard)
+    if more and cursor:
+        deferred.defer(sync_issue_pulls, issue_key, shard,
+                       cursor=cursor.urlsafe(), publisher_key=publisher_key,
+                       batch_size=batch_size, deadline=deadline)
+
+def new_pull(issue_key, values, user, publisher=None, subscription=None):
+    pull = Pull(
+        key=ndb.Key(Pull, issue_key.id(), parent=user),
+        identifier=int(issue_key.id()),
+        issue=issue_key,
+        publisher=publisher,
+        subscription=subscription,
+    )
+    sync_pull(pull, values)
+    return pull
+
+@ndb.transactional_tasklet
+def insert_pull_async(issue_key, values, user, publisher, subscription):
+    '''Create the pull of an issue for a user if it does not exist.
+
+    An existing pull keeps its own values, such as pulled and read, and
+    only gains the subscription if it was created for a watcher.  Returns
+    True if the pull was created.
+    '''
+    key = ndb.Key(Pull, issue_key.id(), parent=user)
+    pull = yield key.get_async()
+    if pull:
+        if subscription and not pull.subscription:
+            pull.subscription = subscription
+            yield entity_cache.put_async(pull)
+        raise ndb.Return(False)
+    pull = new_pull(issue_key, values, user, publisher, subscription)
+    yield entity_cache.put_async(pull)
+    raise ndb.Return(True)
+
+def create_pulls(issue_key, values, publisher, user_subscriptions):
+    '''Create missing pulls of an issue for a batch of users.
+
+    user_subscriptions maps user keys to their subscription key (or None
+    for watchers).  Each pull is inserted in its own transaction, so the
+    subscriber and watcher tasks of an issue, and pulls added by users,
+    never overwrite each other.  Returns the number of pulls created.
+    '''
+    user_keys = user_subscriptions.keys()
+    created = 0
+    for index in range(0, len(user_keys), FANOUT_BATCH):
+        futures = [
+            insert_pull_async(issue_key, values, user, publisher,
+                              user_subscriptions[user])
+            for user in user_keys[index:index + FANOUT_BATCH]]
+        created += sum(1 for future in futures if future.get_result())
+    return created
+
+def queue_new_issue(issue_key, values):
+    '''Fan out a new issue to the subscribers and watchers of its volume.
+
+    The volume is loaded once here and its publisher passed to every task.
+    '''
+    publisher = None
+    if values.get('volume'):
+        volume = values['volume'].get()
+        if volume:
+            publisher = volume.publisher
+        deferred.defer(create_subscriber_pulls, issue_key, values, publisher)
+    for collection_key in values.get('collection', []):
+        deferred.defer(create_watcher_pulls, issue_key, values, publisher,
+                       collection_key)
+
+def create_subscriber_pulls(issue_key, values, publisher, cursor=None,
+                            batch_size=NEW_ISSUE_BATCH,
+                            deadline=FANOUT_DEADLINE):
+    start = time()
+    query = subscriptions.Subscription.query(
+        subscriptions.Subscription.volume == values['volume'])
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+    created = 0
+    more = True
+    while more and time() - start < deadline:
+        keys, cursor, more = query.fetch_page(
+            batch_size, keys_only=True, start_cursor=cursor)
+        created += create_pulls(
+            issue_key, values, publisher,
+            dict((key.parent(), key) for key in keys))
+    logging.info('Created %d subscriber pulls for issue %s',
+                 created, issue_key.id())
+    if more and cursor:
+        deferred.defer(create_subscriber_pulls, issue_key, values, publisher,
+                       cursor=cursor.urlsafe(), batch_size=batch_size,
+                       deadline=deadline)
+
+def create_watcher_pulls(issue_key, values, publisher, collection_key,
+                         cursor=None, batch_size=NEW_ISSUE_BATCH,
+                         deadline=FANOUT_DEADLINE):
+    start = time()
+    query = subscriptions.WatchList.query(
+        subscriptions.WatchList.collection == collection_key)
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+    created = 0
+    more = True
+    while more and time() - start < deadline:
+        keys, cursor, more = query.fetch_page(
+            batch_size, keys_only=True, start_cursor=cursor)
+        watchers = set(key.parent() for key in keys if key.parent())
+        # Watches created before they were parented are read for the user
+        legacy = [key for key in keys if not key.parent()]
+        watchers.update(
+            watch.user for watch in ndb.get_multi(legacy)
+            if watch and watch.user)
+        created += create_pulls(
+            issue_key, values, publisher,
+            dict((user, None) for user in watchers))
+    logging.info('Created %d pulls for issue %s watchers of %r',
+                 created, issue_key.id(), collection_key)
+    if more and cursor:
+        deferred.defer(create_watcher_pulls, issue_key, values, publisher,
+                       collection_key, cursor=cursor.urlsafe(),
+                       batch_size=batch_size, deadline=deadline)
+
 def pull_key(data, user=None, create=True, batch=False):
     if not user:
         user = users.user_key()
@@ -80,12 +272,11 @@ def pull_key(data, user=None, create=True, batch=False):
                 pull.subscription = subscription_key
             changed = True
 
-        if pull.pubdate != issue.pubdate:
-            pull.pubdate = issue.pubdate
+        if sync_pull(pull, {'pubdate': issue.pubdate}):
             changed = True
         logging.info('Updating pull for issue %s', pull_id)
         if batch:
             return pull
-        pull.put()
+        entity_cache.put(pull)
 
     return key
@@ -0,0 +1,143 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Cached, cursor paginated queries over the search indexes.'''
+from datetime import date
+from hashlib import sha1
+import logging
+
+from google.appengine.api import memcache #pylint: disable=import-error
+
+from pulldb.models import documents
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Results are cached once a query has been seen this many times within
+# the popularity window.
+POPULAR_THRESHOLD = 2
+POPULARITY_WINDOW = 3600
+CACHE_TTL = 3600
+
+# Returned fields and sort order for each index.  Field names match those
+# written by the index_document methods of the models.
+SCHEMAS = {
+    documents.ISSUE_INDEX: {
+        'fields': [
+            'issue_id', 'name', 'title', 'issue_number', 'pubdate',
+            'volume_id', 'volume',
+        ],
+        'sort': 'pubdate',
+        'sort_default': date.min,
+    },
+    documents.VOLUME_INDEX: {
+        'fields': ['volume_id', 'name', 'start_year'],
+        'sort': 'start_year',
+        'sort_default': 0,
+    },
+    documents.ARC_INDEX: {
+        'fields': ['arc_id', 'name', 'deck'],
+        'sort': None,
+    },
+}
+
+
+class SearchPage(object):
+    #pylint: disable=too-few-public-methods
+    def __init__(self, results, cursor=None, count=0, cached=False):
+        self.results = results
+        self.cursor = cursor
+        self.count = count
+        self.cached = cached
+
+    def __repr__(self):
+        return 'SearchPage(count=%r, results=%d, cursor=%r, cached=%r)' % (
+            self.count, len(self.results), self.cursor, self.cached)
+
+
+def cache_key(index_name, query_string, cursor, limit, ascending):
+    query_id = repr((query_string, cursor, limit, ascending))
+    return '%s:%s:%s' % (
+        index_name, documents.index_generation(index_name),
+        sha1(query_id.encode('utf-8')).hexdigest())
+
+def build_query(index_name, query_string, cursor=None, limit=PAGE_SIZE,
+                ascending=False):
+    search = documents.search_api()
+    schema = SCHEMAS[index_name]
+    options = {
+        'limit': min(limit, MAX_PAGE_SIZE),
+        'cursor': search.Cursor(web_safe_string=cursor),
+        'returned_fields': schema['fields'],
+    }
+    if schema['sort']:
+        if ascending:
+            direction = search.SortExpression.ASCENDING
+        else:
+            direction = search.SortExpression.DESCENDING
+        options['sort_options'] = search.SortOptions(expressions=[
+            search.SortExpression(
+                expression=schema['sort'],
+                direction=direction,
+                default_value=schema['sort_default'],
+            )
+        ])
+    return search.Query(
+        query_string=query_string,
+        options=search.QueryOptions(**options),
+    )
+
+def result_to_dict(document):
+    result = {'id': document.doc_id}
+    for field in document.fields:
+        # Only the first value of a repeated field is returned
+        result.setdefault(field.name, field.value)
+    return result
+
+def run_query(index_name, query_string, cursor=None, limit=PAGE_SIZE,
+              ascending=False):
+    search = documents.search_api()
+    query = build_query(
+        index_name, query_string, cursor=cursor, limit=limit,
+        ascending=ascending)
+    try:
+        results = search.Index(name=index_name).search(query)
+    except search.Error as error:
+        logging.exception('Search failed: %r', error)
+        return SearchPage([])
+    next_cursor = None
+    if results.cursor:
+        next_cursor = results.cursor.web_safe_string
+    return SearchPage(
+        [result_to_dict(document) for document in results.results],
+        cursor=next_cursor,
+        count=results.number_found,
+    )
+
+def cached_query(index_name, query_string, cursor=None, limit=PAGE_SIZE,
+                 ascending=False):
+    '''Run a search query, using memcache for popular queries.
+
+    Cached pages are keyed on the index generation so they are replaced
+    as soon as updated documents are put into the index.
+    '''
+    key = cache_key(index_name, query_string, cursor, limit, ascending)
+    page = memcache.get(key, namespace='search')
+    if page:
+        page.cached = True
+        return page
+    page = run_query(index_name, query_string, cursor=cursor, limit=limit,
+                     ascending=ascending)
+    memcache.add(key, 0, POPULARITY_WINDOW, namespace='search_popularity')
+    hits = memcache.incr(key, namespace='search_popularity') or 0
+    if hits >= POPULAR_THRESHOLD and page.results:
+        logging.debug('Caching popular query %r: %r', query_string, page)
+        memcache.set(key, page, CACHE_TTL, namespace='search')
+    return page
+
+def search_issues(query_string, **kwargs):
+    return cached_query(documents.ISSUE_INDEX, query_string, **kwargs)
+
+def search_volumes(query_string, **kwargs):
+    return cached_query(documents.VOLUME_INDEX, query_string, **kwargs)
+
+def search_arcs(query_string, **kwargs):
+    return cached_query(documents.ARC_INDEX, query_string, **kwargs)
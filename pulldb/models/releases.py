@@ -0,0 +1,152 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+from datetime import date, datetime, timedelta
+import logging
+
+from google.appengine.ext import deferred # pylint: disable=import-error
+from google.appengine.ext import ndb # pylint: disable=import-error
+
+from pulldb.models import entity_cache
+from pulldb.models import subscriptions
+from pulldb.models import users
+
+
+class Release(ndb.Model):
+    '''Issues released for a volume in a week.
+
+    Keyed by week and volume id (eg. 2014-W05:12345) so that the releases
+    for a set of volumes can be fetched with a single get_multi.
+    '''
+    # pylint: disable=no-init,too-few-public-methods
+    changed = ndb.DateTimeProperty(auto_now=True)
+    issues = ndb.KeyProperty(kind='Issue', repeated=True, indexed=False)
+    pubdates = ndb.DateProperty(repeated=True, indexed=False)
+    volume = ndb.KeyProperty(kind='Volume')
+    week = ndb.StringProperty()
+
+    def add(self, issue_key, pubdate):
+        if issue_key in self.issues:
+            index = self.issues.index(issue_key)
+            if self.pubdates[index] == pubdate:
+                return False
+            self.pubdates[index] = pubdate
+        else:
+            self.issues.append(issue_key)
+            self.pubdates.append(pubdate)
+        return True
+
+    def entries(self):
+        return zip(self.issues, self.pubdates)
+
+    def remove(self, issue_key):
+        if issue_key not in self.issues:
+            return False
+        index = self.issues.index(issue_key)
+        del self.issues[index]
+        del self.pubdates[index]
+        return True
+
+
+def week_id(pubdate):
+    year, week, _ = pubdate.isocalendar()
+    return '%04d-W%02d' % (year, week)
+
+def current_week():
+    return week_id(date.today())
+
+def week_start(week):
+    '''First day (Monday) of an iso week id.'''
+    year, week = week.split('-W')
+    fourth = date(int(year), 1, 4)
+    return fourth + timedelta(weeks=int(week) - 1, days=-fourth.weekday())
+
+def release_key(week, volume_key):
+    return ndb.Key(Release, '%s:%s' % (week, volume_key.id()))
+
+def week_releases(week, volume_keys):
+    releases = ndb.get_multi(
+        [release_key(week, volume_key) for volume_key in volume_keys])
+    return [release for release in releases if release]
+
+def user_releases(week=None, user=None):
+    '''Releases for the volumes a user is subscribed to.
+
+    Subscriptions are keyed by volume id so the subscribed volumes are
+    found with a keys only query.
+    '''
+    if not week:
+        week = current_week()
+    if not user:
+        user = users.user_key()
+    query = subscriptions.Subscription.query(ancestor=user)
+    volume_keys = [
+        ndb.Key('Volume', key.id()) for key in query.iter(keys_only=True)]
+    return week_releases(week, volume_keys)
+
+@ndb.transactional(xg=True)
+def record_release(issue_key, volume_key, pubdate,
+                   previous_volume=None, previous_pubdate=None):
+    '''Move an issue into the release for its volume and week.'''
+    keys = [release_key(week_id(pubdate), volume_key)]
+    if previous_volume and previous_pubdate:
+        previous_key = release_key(week_id(previous_pubdate), previous_volume)
+        if previous_key != keys[0]:
+            keys.append(previous_key)
+    releases = ndb.get_multi(keys)
+    release = releases[0] or Release(
+        key=keys[0], week=week_id(pubdate), volume=volume_key)
+    changed = [old for old in releases[1:] if old and old.remove(issue_key)]
+    if release.add(issue_key, pubdate):
+        changed.append(release)
+    if changed:
+        entity_cache.put_multi(changed)
+    return bool(changed)
+
+@ndb.transactional_tasklet
+def add_to_release(week, volume_key, entries):
+    '''Add (issue key, pubdate) entries to a release.
+
+    Returns True if the release changed.
+    '''
+    key = release_key(week, volume_key)
+    release = yield key.get_async()
+    if not release:
+        release = Release(key=key, week=week, volume=volume_key)
+    updated = False
+    for issue_key, pubdate in entries:
+        updated = release.add(issue_key, pubdate) or updated
+    if updated:
+        yield entity_cache.put_async(release)
+    raise ndb.Return(updated)
+
+def backfill_releases(cursor=None, batch_size=200):
+    '''Build releases for all existing issues.
+
+    Walks issues by cursor, continuing in a new task until done.  Each
+    release is updated in its own transaction, as record_release does, so
+    the backfill does not overwrite concurrent incremental updates.
+    '''
+    query = ndb.Query(kind='Issue')
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+    issues, next_cursor, more = query.fetch_page(
+        batch_size, start_cursor=cursor)
+    grouped = {}
+    for issue in issues:
+        if issue.key.parent() or not issue.volume or not issue.pubdate:
+            # Legacy volume parented issues are skipped
+            continue
+        pubdate = issue.pubdate
+        if isinstance(pubdate, datetime):
+            pubdate = pubdate.date()
+        release = (week_id(pubdate), issue.volume)
+        grouped.setdefault(release, []).append((issue.key, pubdate))
+    futures = [
+        add_to_release(week, volume_key, entries)
+        for (week, volume_key), entries in grouped.items()]
+    changed = sum(1 for future in futures if future.get_result())
+    logging.info('Backfilled %d releases from %d issues',
+                 changed, len(issues))
+    if more and next_cursor:
+        deferred.defer(backfill_releases, cursor=next_cursor.urlsafe(),
+                       batch_size=batch_size)
@@ -0,0 +1,153 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Stable shard assignment using consistent hashing.
+
+Entities are placed on a hash ring with a number of virtual nodes for
+each shard.  Increasing the shard count only moves the entities claimed
+by the new shards, so existing assignments remain valid and rebalancing
+can be done in the background.
+'''
+from bisect import bisect
+from hashlib import md5
+import logging
+from time import time
+
+from google.appengine.ext import deferred #pylint: disable=import-error
+from google.appengine.ext import ndb #pylint: disable=import-error
+
+from pulldb.models import admin
+from pulldb.models import entity_cache
+
+DEFAULT_SHARD_COUNT = 16
+VIRTUAL_NODES = 64
+UNASSIGNED = -1
+# Kinds which carry a shard property assigned at write time
+SHARDED_KINDS = [
+    'Issue', 'Volume', 'StoryArc', 'WatchList', 'Subscription', 'Pull',
+]
+
+# The shard count is held on a fixed key so it can be read with a get
+SHARD_COUNT_KEY = ndb.Key('Setting', 'shard_count')
+
+_RINGS = {}
+_SHARD_COUNT = {'value': None, 'expires': 0}
+
+
+def _hash(value):
+    return int(md5(str(value)).hexdigest()[:8], 16)
+
+def ring(shard_count):
+    if shard_count not in _RINGS:
+        points = []
+        for shard in range(shard_count):
+            for replica in range(VIRTUAL_NODES):
+                points.append((_hash('%d:%d' % (shard, replica)), shard))
+        points.sort()
+        _RINGS[shard_count] = (
+            [point for point, _ in points],
+            [shard for _, shard in points],
+        )
+    return _RINGS[shard_count]
+
+@ndb.non_transactional
+def load_shard_count():
+    '''Read the configured number of shards from the datastore.
+
+    assign_shard runs in the _pre_put_hook of entities written inside
+    transactions, so the setting is read outside any current transaction.
+    Counts set before the fixed key was used are read from the named
+    setting.
+    '''
+    setting = SHARD_COUNT_KEY.get()
+    if setting is None:
+        return admin.setting_value('shard_count', DEFAULT_SHARD_COUNT, int)
+    return int(setting.value)
+
+def shard_count():
+    '''Configured number of shards, cached in process for a minute.'''
+    if _SHARD_COUNT['expires'] < time():
+        _SHARD_COUNT['value'] = load_shard_count()
+        _SHARD_COUNT['expires'] = time() + 60
+    return _SHARD_COUNT['value']
+
+def shard_for(identifier, count=None):
+    if not count:
+        count = shard_count()
+    points, shards = ring(count)
+    index = bisect(points, _hash(identifier)) % len(points)
+    return shards[index]
+
+def shard_identifier(entity):
+    '''Identifier used to place an entity on the ring.
+
+    Subscriptions are keyed on their volume id so they share the shard of
+    the volume.  Watches are placed by the collection they watch and pulls
+    by their user, so the pulls of an issue are spread across shards.
+    '''
+    if entity.key and entity.key.kind() == 'Pull':
+        return entity.key.parent().id()
+    collection = getattr(entity, 'collection', None)
+    if isinstance(collection, ndb.Key):
+        return collection.id()
+    if entity.key:
+        return entity.key.id()
+
+def assign_shard(entity, count=None):
+    '''Set the shard of an entity if it has not been assigned.
+
+    Intended to be called from _pre_put_hook.  Assigned shards are left
+    alone so that entities only move during a rebalance.
+    '''
+    if entity.shard is not None and entity.shard != UNASSIGNED:
+        return entity.shard
+    identifier = shard_identifier(entity)
+    if identifier is not None:
+        entity.shard = shard_for(identifier, count)
+    return entity.shard
+
+def shard_query(model, shard, *filters):
+    return model.query(model.shard == shard, *filters)
+
+def set_shard_count(count):
+    '''Change the shard count and queue a rebalance of all sharded kinds.
+
+    Shards up to the larger of the old and new counts are walked, so when
+    the count shrinks the entities in the removed shards are moved too.
+    '''
+    old_count = load_shard_count()
+    entity_cache.put(admin.Setting(
+        key=SHARD_COUNT_KEY, name='shard_count', value=str(count)))
+    _SHARD_COUNT['expires'] = 0
+    for kind in SHARDED_KINDS:
+        for shard in [UNASSIGNED] + range(max(old_count, count)):
+            deferred.defer(rebalance, kind, shard, count)
+
+def rebalance(kind, shard, count, cursor=None, batch_size=200):
+    '''Move entities in shard to their assignment for count shards.
+
+    Walks the shard by cursor and writes only entities whose assignment
+    changed.  Continues in a new task until the shard is exhausted.
+    '''
+    # pylint: disable=protected-access
+    model = ndb.Model._lookup_model(kind)
+    query = shard_query(model, shard)
+    if cursor:
+        cursor = ndb.Cursor(urlsafe=cursor)
+    entities, next_cursor, more = query.fetch_page(
+        batch_size, start_cursor=cursor)
+    moved = []
+    for entity in entities:
+        identifier = shard_identifier(entity)
+        if identifier is None:
+            continue
+        new_shard = shard_for(identifier, count)
+        if new_shard != entity.shard:
+            entity.shard = new_shard
+            moved.append(entity)
+    if moved:
+        entity_cache.put_multi(moved)
+    logging.info('Rebalanced %s shard %d: %d/%d moved',
+                 kind, shard, len(moved), len(entities))
+    if more and next_cursor:
+        deferred.defer(rebalance, kind, shard, count,
+                       cursor=next_cursor.urlsafe(), batch_size=batch_size)
@@ -0,0 +1,141 @@
+# Copyright 2013 Russell Heilling
+# pylint: disable=missing-docstring
+'''Issue dates and counts of volumes and story arcs.
+
+first_issue_date, last_issue_date and issue_count are computed from the
+stored issues with projection queries on pubdate, which need composite
+indexes on Issue (volume, pubdate) and (collection, pubdate).  Issues
+without a pubdate are counted but don't affect the dates.  Until the
+legacy issue migration is complete, issues are counted from a keys only
+query so that volume parented copies are not counted twice.
+
+Changed issues queue an update of their volume and arcs.  Updates are
+named by collection and time window, so a burst of changes to the issues
+of one volume results in a single update at the end of the window.  The
+volume_statistics and arc_statistics jobs recompute every collection.
+'''
+from datetime import datetime
+import logging
+from time import time
+
+from google.appengine.api import taskqueue # pylint: disable=import-error
+from google.appengine.ext import deferred # pylint: disable=import-error
+from google.appengine.ext import ndb # pylint: disable=import-error
+
+from pulldb.models import entity_cache
+from pulldb.models import jobs
+from pulldb.models import migrations
+from pulldb.models.migrations import LEGACY_MIGRATION
+
+# Seconds over which changes to a collection are coalesced
+UPDATE_WINDOW = 60
+
+
+def issue_query(collection_key):
+    if collection_key.kind() == 'Volume':
+        prop = ndb.GenericProperty('volume')
+    else:
+        prop = ndb.GenericProperty('collection')
+    return ndb.Query(kind='Issue').filter(prop == collection_key)
+
+@ndb.tasklet
+def issue_count_async(query):
+    if migrations.is_complete(LEGACY_MIGRATION):
+        count = yield query.count_async()
+    else:
+        keys = yield query.fetch_async(keys_only=True)
+        count = len([key for key in keys if not key.parent()])
+    raise ndb.Return(count)
+
+@ndb.tasklet
+def collection_statistics_async(collection_key):
+    '''Returns (first pubdate, last pubdate, issue count).'''
+    query = issue_query(collection_key)
+    pubdate = ndb.GenericProperty('pubdate')
+    # Undated issues would sort first
+    dated = query.filter(pubdate > datetime.min)
+    first, last, count = yield (
+        dated.order(pubdate).fetch_async(1, projection=['pubdate']),
+        dated.order(-pubdate).fetch_async(1, projection=['pubdate']),
+        issue_count_async(query),
+    )
+    first_date = first[0].pubdate if first else None
+    last_date = last[0].pubdate if last else None
+    raise ndb.Return(first_date, last_date, count)
+
+def as_date(value):
+    if hasattr(value, 'date'):
+        return value.date()
+    return value
+
+def apply_statistics(entity, first_date, last_date, count):
+    '''Set the statistics of a volume or arc, returning True if changed.'''
+    values = {
+        'first_issue_date': as_date(first_date),
+        'issue_count': count,
+    }
+    if hasattr(entity, 'last_issue_date'):
+        values['last_issue_date'] = as_date(last_date)
+    changed = False
+    for name, value in values.items():
+        if getattr(entity, name) != value:
+            setattr(entity, name, value)
+            changed = True
+    if not entity.complete:
+        entity.complete = True
+        changed = True
+    return changed
+
+def refresh_statistics(entities):
+    '''Recompute the statistics of entities, returning those changed.'''
+    futures = [
+        collection_statistics_async(entity.key) for entity in entities]
+    changed = []
+    for entity, future in zip(entities, futures):
+        if apply_statistics(entity, *future.get_result()):
+            changed.append(entity)
+    return changed
+
+def update_statistics(collection_keys):
+    entities = [
+        entity for entity in ndb.get_multi(collection_keys) if entity]
+    changed = refresh_statistics(entities)
+    if changed:
+        entity_cache.put_multi(changed)
+    logging.info('Updated statistics of %d/%d collections',
+                 len(changed), len(entities))
+
+def queue_update(collection_keys):
+    '''Queue a statistics update for each collection after the window.'''
+    window = int(time() // UPDATE_WINDOW)
+    countdown = (window + 1) * UPDATE_WINDOW - time() + 1
+    for key in collection_keys:
+        if key.kind() not in ('Volume', 'StoryArc'):
+            continue
+        name = 'statistics-%s-%s-%d' % (key.kind(), key.id(), window)
+        try:
+            deferred.defer(update_statistics, [key], _name=name,
+                           _countdown=countdown)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+class CollectionStatistics(jobs.ChunkedJob):
+    batch_size = 50
+    chunk_size = 50
+
+    def process(self, entities):
+        return refresh_statistics(entities)
+
+
+@jobs.register
+class VolumeStatistics(CollectionStatistics):
+    name = 'volume_statistics'
+    kind = 'Volume'
+
+
+@jobs.register
+class ArcStatistics(CollectionStatistics):
+    name = 'arc_statistics'
+    kind = 'StoryArc'
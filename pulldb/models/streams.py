@@ -1,8 +1,12 @@
 # Copyright 2013 Russell Heilling
-from datetime import datetime
+from bisect import bisect_left
+from datetime import date, datetime
+import logging
 
 from google.appengine.ext import ndb
 
+from pulldb.models import entity_cache
+
 from pulldb.models import users
 
 class Stream(ndb.Model):
@@ -11,6 +15,8 @@ class Stream(ndb.Model):
     Holds issue stream data.  Parent key should be a subscription.
     '''
     name = ndb.StringProperty()
+    # Unused, issues are held in StreamPage.  rebuild_stream clears the
+    # list left on streams written before pages were used.
     issues = ndb.KeyProperty(kind='Issue', repeated=True)
     length = ndb.IntegerProperty()
     publishers = ndb.KeyProperty(kind='Publisher', repeated=True)
@@ -18,6 +24,159 @@ class Stream(ndb.Model):
     user = ndb.KeyProperty(kind='User')
     volumes = ndb.KeyProperty(kind='Volume', repeated=True)
 
+
+class StreamPage(ndb.Model):
+    '''Page of issues in a stream.
+
+    Parent key should be a stream.  Pages are keyed by month (YYYY-MM) and
+    hold the issues published in that month ordered by pubdate.
+    '''
+    changed = ndb.DateTimeProperty(auto_now=True)
+    issues = ndb.KeyProperty(kind='Issue', repeated=True, indexed=False)
+    pubdates = ndb.DateProperty(repeated=True, indexed=False)
+
+    def entries(self):
+        return zip(self.pubdates, self.issues)
+
+    def insert(self, issue_key, pubdate):
+        entry = (pubdate, issue_key)
+        if entry in self.entries():
+            return False
+        entries = [item for item in self.entries() if item[1] != issue_key]
+        entries.insert(bisect_left(entries, entry), entry)
+        self.pubdates = [item[0] for item in entries]
+        self.issues = [item[1] for item in entries]
+        return True
+
+    def remove(self, issue_key):
+        entries = [item for item in self.entries() if item[1] != issue_key]
+        if len(entries) == len(self.issues):
+            return False
+        self.pubdates = [item[0] for item in entries]
+        self.issues = [item[1] for item in entries]
+        return True
+
+
+def page_id(pubdate):
+    return '%04d-%02d' % (pubdate.year, pubdate.month)
+
+def page_key(stream_key, pubdate):
+    return ndb.Key(StreamPage, page_id(pubdate), parent=stream_key)
+
+def page_keys(stream_key, start, end):
+    keys = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        keys.append(page_key(stream_key, date(year, month, 1)))
+        year, month = year + month // 12, month % 12 + 1
+    return keys
+
+def stream_issues(stream_key, start, end, limit=None):
+    '''Fetch the issue keys in a window of a stream.
+
+    Only the pages covering start to end are loaded.  Returns a list of
+    (pubdate, issue_key) tuples in date order.
+    '''
+    window = []
+    pages = ndb.get_multi(page_keys(stream_key, start, end))
+    for page in pages:
+        if not page:
+            continue
+        window.extend(
+            entry for entry in page.entries() if start <= entry[0] <= end)
+        if limit and len(window) >= limit:
+            break
+    if limit:
+        window = window[:limit]
+    return window
+
+def matching_streams(volume_key, publisher_key=None):
+    stream_keys = set(
+        Stream.query(Stream.volumes == volume_key).iter(keys_only=True))
+    if publisher_key:
+        stream_keys.update(Stream.query(
+            Stream.publishers == publisher_key).iter(keys_only=True))
+    return stream_keys
+
+@ndb.transactional_tasklet
+def place_issue(stream_key, issue_key, pubdate, previous_pubdate=None):
+    new_key = page_key(stream_key, pubdate)
+    keys = [stream_key, new_key]
+    if previous_pubdate and page_id(previous_pubdate) != page_id(pubdate):
+        keys.append(page_key(stream_key, previous_pubdate))
+    entities = yield ndb.get_multi_async(keys)
+    stream = entities[0]
+    if not stream:
+        raise ndb.Return(False)
+    pages = [entities[1] or StreamPage(key=new_key)]
+    if len(entities) > 2 and entities[2]:
+        pages.append(entities[2])
+    before = sum(len(page.issues) for page in pages)
+    if stream.start and pubdate < stream.start:
+        # Moved before the start of the stream, so drop any old entry
+        changed = [page for page in pages if page.remove(issue_key)]
+    else:
+        changed = [page for page in pages[1:] if page.remove(issue_key)]
+        if pages[0].insert(issue_key, pubdate):
+            changed.append(pages[0])
+    if changed:
+        after = sum(len(page.issues) for page in pages)
+        stream.length = (stream.length or 0) + after - before
+        yield entity_cache.put_multi_async(changed + [stream])
+    raise ndb.Return(bool(changed))
+
+def update_issue_streams(issue_key, volume_key, pubdate,
+                         previous_pubdate=None):
+    '''Add a new or changed issue to the streams which include it.
+
+    Streams include an issue when they list its volume or the publisher
+    of its volume.  Intended to be run from the task queue when an issue
+    is written.
+    '''
+    if not pubdate:
+        return 0
+    volume = volume_key.get()
+    publisher_key = volume.publisher if volume else None
+    futures = [
+        place_issue(stream_key, issue_key, pubdate, previous_pubdate)
+        for stream_key in matching_streams(volume_key, publisher_key)
+    ]
+    updated = sum(1 for future in futures if future.get_result())
+    logging.info('Issue %s placed in %d/%d streams',
+                 issue_key.id(), updated, len(futures))
+    return updated
+
+def rebuild_stream(stream_key, batch_size=100):
+    '''Recompute all pages of a stream from its volumes and publishers.'''
+    stream = stream_key.get()
+    volume_keys = set(stream.volumes)
+    for publisher_key in stream.publishers:
+        volume_keys.update(ndb.Query(kind='Volume').filter(
+            ndb.GenericProperty('publisher') == publisher_key).iter(
+                keys_only=True))
+    pages = {}
+    for volume_key in volume_keys:
+        query = ndb.Query(kind='Issue').filter(
+            ndb.GenericProperty('volume') == volume_key)
+        for issue in query.iter(batch_size=batch_size):
+            if not issue.pubdate:
+                continue
+            if stream.start and issue.pubdate < stream.start:
+                continue
+            key = page_key(stream_key, issue.pubdate)
+            if key not in pages:
+                pages[key] = StreamPage(key=key)
+            pages[key].insert(issue.key, issue.pubdate)
+    stale = set(StreamPage.query(ancestor=stream_key).iter(keys_only=True))
+    stale.difference_update(pages)
+    stream.length = sum(len(page.issues) for page in pages.values())
+    stream.issues = []
+    entity_cache.put_multi(pages.values() + [stream])
+    entity_cache.delete_multi(list(stale))
+    logging.info('Rebuilt stream %r: %d issues in %d pages',
+                 stream_key, stream.length, len(pages))
+    return stream.length
+
 def stream_key(stream_data, user_key=None, create=False, batch=False):
     if not user_key:
         user_key = users.user_key()
@@ -34,6 +193,6 @@ def stream_key(stream_data, user_key=None, create=False, batch=False):
             stream.populate(**stream_data)
         if batch:
             return stream
-        stream.put()
+        entity_cache.put(stream)
 
     return stream_key
@@ -6,6 +6,9 @@ import logging
 from google.appengine.ext import ndb # pylint: disable=import-error
 
 from pulldb.models import arcs
+from pulldb.models import entity_cache
+from pulldb.models import loader
+from pulldb.models import shards
 from pulldb.models import users
 from pulldb.models import volumes
 
@@ -16,6 +19,8 @@ class NoSuchCollection(Exception):
 class WatchList(ndb.Model):
     '''WatchList object in datastore.
 
+    Parent should be User.  Watches created before they were parented
+    only hold the user in the user property.
     '''
     # pylint: disable=no-init,too-few-public-methods
     changed = ndb.DateTimeProperty(auto_now=True)
@@ -25,6 +30,9 @@ class WatchList(ndb.Model):
     start_date = ndb.DateProperty(default=datetime.min)
     user = ndb.KeyProperty(kind='User')
 
+    def _pre_put_hook(self):
+        shards.assign_shard(self)
+
 
 class Subscription(ndb.Model):
     '''Subscription object in datastore.
@@ -44,35 +52,89 @@ class Subscription(ndb.Model):
     volume_last_issue = ndb.KeyProperty(kind='Issue')
     volume_last_issue_date = ndb.DateTimeProperty()
 
+    def _pre_put_hook(self):
+        shards.assign_shard(self)
 
-@ndb.tasklet
-def refresh_subscription(subscription):
-    volume = yield subscription.volume.get_async()
+
+def shard_volume_keys(shard):
+    '''Keys of the subscribed volumes assigned to shard.
+
+    Subscriptions are keyed by volume id so the volume keys are found with
+    a keys only query without loading any subscriptions or volumes.
+    '''
+    query = shards.shard_query(Subscription, shard)
+    volume_keys = set()
+    for key in query.iter(keys_only=True):
+        volume_keys.add(ndb.Key(volumes.Volume, key.id()))
+    return sorted(volume_keys)
+
+def as_datetime(value):
+    if value and not isinstance(value, datetime):
+        return datetime.combine(value, datetime.min.time())
+    return value
+
+def apply_volume(subscription, volume):
+    '''Copy the deprecated first/last issue fields from a volume.
+
+    Returns True if the subscription was changed.
+    '''
     changed = False
+    updates = []
     if volume.first_issue:
-        if subscription.volume_first_issue != volume.first_issue:
-            subscription.volume_first_issue = volume.first_issue
-            changed = True
-        if subscription.volume_first_issue_date != volume.first_issue_date:
-            subscription.volume_first_issue_date = volume.first_issue_date
-            changed = True
+        updates.extend([
+            ('volume_first_issue', volume.first_issue),
+            ('volume_first_issue_date', as_datetime(volume.first_issue_date)),
+        ])
     if volume.last_issue:
-        if subscription.volume_last_issue != volume.last_issue:
-            subscription.volume_last_issue = volume.last_issue
-            changed = True
-        if subscription.volume_last_issue_date != volume.last_issue_date:
-            subscription.volume_last_issue_date = volume.last_issue_date
+        updates.extend([
+            ('volume_last_issue', volume.last_issue),
+            ('volume_last_issue_date', as_datetime(volume.last_issue_date)),
+        ])
+    for attribute, value in updates:
+        if getattr(subscription, attribute) != value:
+            setattr(subscription, attribute, value)
             changed = True
+    return changed
+
+@ndb.tasklet
+def refresh_subscription(subscription):
+    volume = yield subscription.volume.get_async()
+    changed = apply_volume(subscription, volume)
 
     if changed:
-        yield subscription.put_async()
+        yield entity_cache.put_async(subscription)
 
     raise ndb.Return(changed)
 
+def refresh_subscriptions(subscriptions, batch_size=200):
+    '''Refresh many subscriptions with a single load of each volume.
+
+    Volumes are de-duplicated and loaded with get_multi and only changed
+    subscriptions are written.  Returns a tuple of the number of volumes
+    loaded and subscriptions written.
+    '''
+    volume_keys = list(set(
+        subscription.volume for subscription in subscriptions
+        if subscription.volume))
+    loaded = dict(zip(volume_keys, ndb.get_multi(volume_keys)))
+    changed = []
+    for subscription in subscriptions:
+        volume = loaded.get(subscription.volume)
+        if volume and apply_volume(subscription, volume):
+            changed.append(subscription)
+    for index in range(0, len(changed), batch_size):
+        entity_cache.put_multi(changed[index:index + batch_size])
+    logging.info('Refreshed %d subscriptions: %d volumes loaded, '
+                 '%d subscriptions written',
+                 len(subscriptions), len(volume_keys), len(changed))
+    return len(volume_keys), len(changed)
+
 @ndb.tasklet
 def subscription_context(subscription):
-    volume = yield subscription.volume.get_async()
-    publisher = yield volume.publisher.get_async()
+    volume = yield loader.load(subscription.volume)
+    publisher = None
+    if volume:
+        publisher = yield loader.load(volume.publisher)
     raise ndb.Return({
         'subscription': subscription,
         'volume': volume,
@@ -122,11 +184,12 @@ def watch_key(collection_data, user=None, create=False, batch=False):
             logging.error(message)
             raise NoSuchCollection(message)
         watch = WatchList(
+            parent=user,
             user=user,
             collection=collection_key)
         if batch:
-            return watch.put_async()
-        watch.put()
+            return entity_cache.put_async(watch)
+        entity_cache.put(watch)
 
     return watch.key
 
@@ -164,6 +227,6 @@ def subscription_key(volume_data, user=None, create=False, batch=False):
         )
         if batch:
             return subscription
-        subscription.put()
+        entity_cache.put(subscription)
 
     return key
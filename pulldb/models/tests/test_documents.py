@@ -0,0 +1,89 @@
+#pylint: disable=missing-docstring
+import unittest
+
+from pulldb.models import documents
+
+
+class TruncateTest(unittest.TestCase):
+    def test_short_text_unchanged(self):
+        self.assertEqual(u'short text', documents.truncate(u'short text', 100))
+
+    def test_truncates_at_word_boundary(self):
+        self.assertEqual(u'one two', documents.truncate(u'one two three', 9))
+
+    def test_keeps_word_ending_at_cut(self):
+        self.assertEqual(u'one two', documents.truncate(u'one two three', 7))
+
+    def test_single_word_cut_at_limit(self):
+        self.assertEqual(u'abcd', documents.truncate(u'abcdefgh', 4))
+
+    def test_multibyte_text_fits_limit(self):
+        truncated = documents.truncate(u'\u00e9' * 40, 30)
+        self.assertTrue(truncated)
+        self.assertTrue(len(truncated.encode('utf-8')) <= 30)
+
+    def test_strip_html_drops_tables_and_tags(self):
+        html = (u'<p>Hello &amp; <b>world</b></p>'
+                u'<table><tr><td>cover list</td></tr></table>')
+        self.assertEqual(u'Hello & world', documents.strip_html(html))
+
+
+class RoleNamesTest(unittest.TestCase):
+    def test_splits_roles(self):
+        self.assertEqual(['writer', 'cover'],
+                         documents.role_names('writer, cover'))
+
+    def test_invalid_roles_fall_back_to_person(self):
+        self.assertEqual(['inker', 'person'],
+                         documents.role_names('inker, 3d artist'))
+        self.assertEqual(['person'], documents.role_names(None))
+
+
+class DocumentBuilderTest(unittest.TestCase):
+    @staticmethod
+    def names(fields):
+        return [field.name for field in fields]
+
+    def test_required_fields_kept_over_budget(self):
+        builder = documents.DocumentBuilder('1', budget=10)
+        builder.add_text('name', 'a long required name',
+                         documents.PRIORITY_REQUIRED)
+        builder.add_text('deck', 'x' * 50, documents.PRIORITY_HIGH)
+        self.assertEqual(['name'], self.names(builder.fields()))
+        self.assertEqual(['deck'], builder.dropped)
+
+    def test_fields_included_in_priority_order(self):
+        builder = documents.DocumentBuilder('1', budget=30)
+        builder.add_text('description', 'd' * 10, documents.PRIORITY_LOW)
+        builder.add_text('title', 't' * 10, documents.PRIORITY_HIGH)
+        self.assertEqual(['title'], self.names(builder.fields()))
+        self.assertEqual(['description'], builder.dropped)
+        self.assertEqual(15, builder.size)
+
+    def test_duplicate_fields_discarded(self):
+        builder = documents.DocumentBuilder('1')
+        builder.add_people([
+            {'name': 'Alan Moore', 'role': 'writer'},
+            {'name': 'Alan Moore', 'role': 'writer'},
+        ])
+        self.assertEqual(['writer'], self.names(builder.fields()))
+
+    def test_people_added_per_role(self):
+        builder = documents.DocumentBuilder('1')
+        builder.add_people([{'name': 'Alan Moore', 'role': 'writer, cover'}])
+        self.assertEqual(['writer', 'cover'], self.names(builder.fields()))
+
+    def test_description_within_budget(self):
+        builder = documents.DocumentBuilder('1', description_budget=20)
+        builder.add_description('<p>%s</p>' % ('word ' * 20))
+        fields = builder.fields()
+        self.assertEqual(['description'], self.names(fields))
+        self.assertTrue(len(fields[0].value.encode('utf-8')) <= 20)
+
+    def test_build_uses_selected_fields(self):
+        builder = documents.DocumentBuilder('42', budget=10)
+        builder.add_number('issue_id', 42, documents.PRIORITY_REQUIRED)
+        builder.add_text('title', 'x' * 50)
+        document = builder.build()
+        self.assertEqual('42', document.doc_id)
+        self.assertEqual(['issue_id'], self.names(document.fields))
@@ -0,0 +1,112 @@
+#pylint: disable=missing-docstring
+import unittest
+
+from google.appengine.ext import ndb # pylint: disable=import-error
+from google.appengine.ext import testbed # pylint: disable=import-error
+
+from pulldb.models import jobs
+
+
+class Counter(ndb.Model):
+    # pylint: disable=no-init,too-few-public-methods
+    count = ndb.IntegerProperty(default=0)
+
+
+class CountJob(jobs.ChunkedJob):
+    name = 'test_count'
+    kind = 'Counter'
+    batch_size = 3
+    chunk_size = 2
+    deadline = 1.5
+    sharded = False
+
+    def process(self, entities):
+        for entity in entities:
+            entity.count += 1
+        return entities
+
+
+class Clock(object):
+    '''Time which advances a second each time it is read.
+
+    A slice reads the time before each page, so CountJob processes one
+    page per slice.
+    '''
+    #pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class ChunkedJobTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().set_cache_policy(False)
+        self.time = jobs.time
+        jobs.time = Clock()
+        ndb.put_multi([Counter(id=str(index)) for index in range(7)])
+
+    def tearDown(self):
+        jobs.time = self.time
+        self.testbed.deactivate()
+
+    def run_job(self, job):
+        cursors = []
+        cursor = job.run_slice(None)
+        while cursor:
+            cursors.append(cursor)
+            cursor = job.run_slice(None, cursor)
+        return cursors
+
+    def test_resumes_from_cursor(self):
+        cursors = self.run_job(CountJob(run=1))
+        self.assertEqual(2, len(cursors))
+        counts = [counter.count for counter in Counter.query()]
+        self.assertEqual([1] * 7, counts)
+        progress = jobs.progress_key('test_count', None).get()
+        self.assertTrue(progress.done)
+        self.assertEqual(7, progress.processed)
+        self.assertEqual(7, progress.written)
+        self.assertEqual(3, progress.slices)
+        self.assertEqual(5, progress.chunks)
+
+    def test_retried_slice_counted_once(self):
+        job = CountJob(run=1)
+        cursor = job.run_slice(None)
+        job.run_slice(None)
+        progress = jobs.progress_key('test_count', None).get()
+        self.assertEqual(3, progress.processed)
+        self.assertEqual(1, progress.slices)
+        self.assertEqual(cursor, progress.cursor)
+
+    def test_new_run_resets_progress(self):
+        self.run_job(CountJob(run=1))
+        CountJob(run=2).run_slice(None)
+        progress = jobs.progress_key('test_count', None).get()
+        self.assertEqual(2, progress.run)
+        self.assertEqual(3, progress.processed)
+        self.assertFalse(progress.done)
+
+    def test_status_reports_latest_run(self):
+        jobs.JobProgress(
+            key=jobs.progress_key('test_count', 5), name='test_count',
+            run=0, shard=5, processed=100).put()
+        self.run_job(CountJob(run=1))
+        status = jobs.status('test_count')
+        self.assertTrue(status['done'])
+        self.assertEqual(7, status['processed'])
+        self.assertEqual(
+            [None], [shard['shard'] for shard in status['shards']])
+
+    def test_process_required(self):
+        class Incomplete(jobs.ChunkedJob):
+            # pylint: disable=abstract-method
+            name = 'test_incomplete'
+            kind = 'Counter'
+        self.assertRaises(TypeError, Incomplete)
@@ -0,0 +1,28 @@
+#pylint: disable=missing-docstring
+from datetime import date, timedelta
+import unittest
+
+from pulldb.models import releases
+
+
+class WeekTest(unittest.TestCase):
+    def test_week_id(self):
+        self.assertEqual('2014-W05', releases.week_id(date(2014, 1, 30)))
+
+    def test_week_id_at_year_end(self):
+        # ISO weeks belong to the year holding their Thursday
+        self.assertEqual('2015-W01', releases.week_id(date(2014, 12, 29)))
+        self.assertEqual('2015-W53', releases.week_id(date(2016, 1, 1)))
+
+    def test_week_start(self):
+        self.assertEqual(date(2014, 1, 27), releases.week_start('2014-W05'))
+        self.assertEqual(date(2014, 12, 29), releases.week_start('2015-W01'))
+        self.assertEqual(date(2015, 12, 28), releases.week_start('2015-W53'))
+
+    def test_week_start_of_every_day(self):
+        day = date(2014, 12, 1)
+        while day < date(2016, 2, 1):
+            start = releases.week_start(releases.week_id(day))
+            self.assertEqual(0, start.weekday())
+            self.assertTrue(start <= day < start + timedelta(days=7))
+            day += timedelta(days=1)
@@ -0,0 +1,72 @@
+#pylint: disable=missing-docstring
+import unittest
+
+from google.appengine.ext import ndb # pylint: disable=import-error
+from google.appengine.ext import testbed # pylint: disable=import-error
+
+from pulldb.models import shards
+
+IDENTIFIERS = range(2000)
+
+
+class Entity(object):
+    #pylint: disable=too-few-public-methods
+    def __init__(self, key, shard=shards.UNASSIGNED, collection=None):
+        self.key = key
+        self.shard = shard
+        self.collection = collection
+
+
+class RingTest(unittest.TestCase):
+    def test_shards_in_range(self):
+        for identifier in IDENTIFIERS:
+            self.assertTrue(0 <= shards.shard_for(identifier, 16) < 16)
+
+    def test_assignment_is_stable(self):
+        for identifier in IDENTIFIERS:
+            self.assertEqual(shards.shard_for(identifier, 16),
+                             shards.shard_for(str(identifier), 16))
+
+    def test_every_shard_used(self):
+        used = set(shards.shard_for(identifier, 8)
+                   for identifier in IDENTIFIERS)
+        self.assertEqual(set(range(8)), used)
+
+    def test_added_shard_only_takes_entities(self):
+        moved = [
+            identifier for identifier in IDENTIFIERS
+            if shards.shard_for(identifier, 16) !=
+            shards.shard_for(identifier, 17)]
+        self.assertTrue(len(moved) < len(IDENTIFIERS) // 5)
+        for identifier in moved:
+            self.assertEqual(16, shards.shard_for(identifier, 17))
+
+
+class AssignShardTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='pulldb')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_unassigned_entity_placed_by_key(self):
+        entity = Entity(ndb.Key('Volume', '1234'))
+        self.assertEqual(shards.shard_for('1234', 16),
+                         shards.assign_shard(entity, 16))
+
+    def test_assigned_shard_kept(self):
+        entity = Entity(ndb.Key('Volume', '1234'), shard=3)
+        self.assertEqual(3, shards.assign_shard(entity, 16))
+
+    def test_pulls_placed_by_user(self):
+        entity = Entity(ndb.Key('User', 'someone', 'Pull', '1234'))
+        self.assertEqual(shards.shard_for('someone', 16),
+                         shards.assign_shard(entity, 16))
+
+    def test_watches_placed_by_collection(self):
+        entity = Entity(ndb.Key('WatchList', 'a'),
+                        collection=ndb.Key('StoryArc', '55'))
+        self.assertEqual(shards.shard_for('55', 16),
+                         shards.assign_shard(entity, 16))
@@ -5,6 +5,8 @@ from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import ndb
 
+from pulldb.models import entity_cache
+
 class User(ndb.Model):
     '''User object in datastore.
 
@@ -38,10 +40,9 @@ def user_key(app_user=None, create=True, async=False):
         user = User(userid=app_user.user_id(),
                     nickname=app_user.nickname())
         if async:
-            key = user.put_async()
+            key = entity_cache.put_async(user)
         else:
-            user.put()
-            key = user.key
+            key = entity_cache.put(user)
             memcache.add(app_user.user_id(), key, namespace='user')
 
     return key
@@ -2,15 +2,18 @@
 from datetime import datetime
 import logging
 
-from google.appengine.api import search
 from google.appengine.ext import ndb
 
-from dateutil.parser import parse as parse_date
 
 # pylint: disable=F0401
 from pulldb.models import base
 from pulldb.models import comicvine
+from pulldb.models import documents
+from pulldb.models import entity_cache
+from pulldb.models import loader
+from pulldb.models import payloads
 from pulldb.models import publishers
+from pulldb.models import shards
 from pulldb.models.properties import ImageProperty
 
 # pylint: disable=W0232,C0103,E1101,R0201,R0903,R0902
@@ -52,6 +55,9 @@ class Volume(ndb.Model):
             'site_detail_url', 'start_year', 'indexed', 'shard',
         ]
 
+    def _pre_put_hook(self):
+        shards.assign_shard(self)
+
     def apply_changes(self, data):
         # avoid overwriting data with a less complete version by merging
         # the new data over the existing data
@@ -59,9 +65,10 @@ class Volume(ndb.Model):
         merged_data.update(data)
         data = merged_data
 
-        self.json=data
+        self.json = payloads.trim_payload('Volume', data)
+        # issue_count, the issue dates and complete are derived from the
+        # stored issues by statistics, so they are not set from ComicVine.
         self.name=data.get('name', self.name)
-        self.issue_count=data.get('count_of_issues', self.issue_count)
         self.site_detail_url=data.get('site_detail_url', self.site_detail_url)
         if data.get('start_year'):
             try:
@@ -72,20 +79,14 @@ class Volume(ndb.Model):
             self.image = data['image'].get('small_url')
         if data.get('first_issue'):
             first_issue_key = ndb.Key('Issue', str(data['first_issue']['id']))
-            if self.first_issue != first_issue_key:
-                self.first_issue = first_issue_key
-                # Don't fetch the issue data here, queue for batch refresh
-                self.complete = False
+            self.first_issue = first_issue_key
         if data.get('last_issue'):
             last_issue_key = ndb.Key('Issue', str(data['last_issue']['id']))
-            if self.last_issue != last_issue_key:
-                self.last_issue = last_issue_key
-                # Don't fetch the issue data here, queue for batch refresh
-                self.complete = False
+            self.last_issue = last_issue_key
 
         last_updated = data.get('date_last_updated')
         if last_updated:
-            last_updated = parse_date(last_updated)
+            last_updated = base.parse_date(last_updated)
         else:
             last_updated = datetime.min
         if last_updated > self.last_updated:
@@ -98,7 +99,7 @@ class Volume(ndb.Model):
 
         new_data_date = new_data.get('date_last_updated')
         if new_data_date:
-            last_update = parse_date(new_data_date)
+            last_update = base.parse_date(new_data_date)
         else:
             last_update = datetime.min
 
@@ -108,39 +109,21 @@ class Volume(ndb.Model):
         return updates, last_update
 
     def index_document(self, batch=False):
-        document_fields = [
-            search.TextField(name='name', value=self.name),
-            search.NumberField(name='volume_id', value=self.identifier),
-        ]
-        if self.start_year:
-            document_fields.append(
-                search.NumberField(name='start_year', value=self.start_year))
+        document = documents.DocumentBuilder(str(self.identifier))
+        document.add_text('name', self.name, documents.PRIORITY_REQUIRED)
+        document.add_number('volume_id', self.identifier,
+                            documents.PRIORITY_REQUIRED)
+        document.add_number('start_year', self.start_year,
+                            documents.PRIORITY_HIGH)
         if self.json:
-            contributors = self.json.get('people')
-            if contributors:
-                for person in contributors:
-                    document_fields.append(
-                        search.TextField(
-                            name='person', value=person['name']
-                        )
-                    )
-            description = self.json.get('description')
-            if description:
-                document_fields.append(
-                    search.HtmlField(name='description', value=description)
-                )
-
-        volume_doc = search.Document(
-            doc_id=str(self.identifier),
-            fields=document_fields
-        )
+            for person in self.json.get('people') or []:
+                document.add_text('person', person['name'])
+            document.add_description(self.json.get('description'))
+
+        volume_doc = document.build()
         if batch:
             return volume_doc
-        try:
-            index = search.Index(name="volumes")
-            index.put(volume_doc)
-        except search.Error as error:
-            logging.exception('Put failed: %r', error)
+        documents.put_document(documents.VOLUME_INDEX, volume_doc)
 
 def volume_key(volume_data, create=True, reindex=False, batch=False):
     if not volume_data:
@@ -158,7 +141,7 @@ def volume_key(volume_data, create=True, reindex=False, batch=False):
         volume_id = volume_data['id']
 
     key = ndb.Key(Volume, str(volume_id))
-    volume = key.get()
+    volume = entity_cache.get(key)
     changed = False
     if create and not volume:
         if 'publisher' not in volume_data:
@@ -191,14 +174,14 @@ def volume_key(volume_data, create=True, reindex=False, batch=False):
         logging.info('Saving volume updates: %r[%r]',
                      volume.identifier, volume.last_updated)
         if batch:
-            return volume.put_async()
-        volume.put()
+            return entity_cache.put_async(volume)
+        entity_cache.put(volume)
 
     return key
 
 @ndb.tasklet
 def volume_context(volume):
-    publisher = yield volume.publisher.get_async()
+    publisher = yield loader.load(volume.publisher)
     raise ndb.Return({
         'volume': volume,
         'publisher': publisher,
@@ -206,6 +189,10 @@ def volume_context(volume):
 
 @ndb.tasklet
 def refresh_volume_shard(shard, shard_count, subscription, cv):
-    volume = yield subscription.volume.get_async()
-    if volume.identifier % shard_count == shard:
-        raise ndb.Return(volume.identifier)
+    # Subscriptions are keyed by volume id so the volume need not be loaded.
+    # New code should use shards.shard_query or
+    # subscriptions.shard_volume_keys to find the work for a shard.
+    volume_id = subscription.volume.id()
+    # Placed on the same ring as Volume.shard so the two never disagree
+    if shards.shard_for(volume_id, shard_count) == shard:
+        raise ndb.Return(int(volume_id))
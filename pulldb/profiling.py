@@ -0,0 +1,117 @@
+#pylint: disable=missing-docstring
+'''Sampled cProfile of request handlers.
+
+A fraction of requests, or any request from an admin which sets the
+profile header, is run under cProfile.  Function stats are aggregated
+per handler in memcache so hot spots can be found without profiling
+every request.
+'''
+from contextlib import contextmanager
+import json
+import logging
+from random import random
+
+from google.appengine.api import memcache
+from google.appengine.api import users
+
+from pulldb import varz
+
+PROFILE_SAMPLE_RATE = 0.001
+PROFILE_HEADER = 'X-Pulldb-Profile'
+# Functions kept per handler, by cumulative time
+MAX_FUNCTIONS = 200
+PROFILE_TTL = 7 * 24 * 3600
+
+
+def requested(request):
+    '''True if an admin asked for this request to be profiled.'''
+    return bool(request.headers.get(PROFILE_HEADER)) and (
+        users.is_current_user_admin())
+
+def should_profile(request, rate=None):
+    if rate is None:
+        rate = PROFILE_SAMPLE_RATE
+    return requested(request) or random() < rate
+
+def function_name(function):
+    filename, line, name = function
+    return '%s:%d(%s)' % (filename, line, name)
+
+def profile_stats(profile):
+    '''Reduce a profile to {function: [calls, total, cumulative]}.'''
+    import pstats
+    stats = pstats.Stats(profile).stats
+    return dict(
+        (function_name(function), [calls, total, cumulative])
+        for function, (_, calls, total, cumulative, _) in stats.items())
+
+def merge_stats(stored, stats):
+    merged = stored or {'requests': 0, 'functions': {}}
+    merged['requests'] += 1
+    functions = merged['functions']
+    for name, values in stats.items():
+        current = functions.get(name, [0, 0.0, 0.0])
+        functions[name] = [a + b for a, b in zip(current, values)]
+    if len(functions) > MAX_FUNCTIONS:
+        top = sorted(functions.items(), key=lambda item: -item[1][2])
+        merged['functions'] = dict(top[:MAX_FUNCTIONS])
+    return merged
+
+def store_profile(handler, profile):
+    stats = profile_stats(profile)
+    varz.update_memcache(
+        handler, lambda stored: merge_stats(stored, stats), 'profile',
+        PROFILE_TTL)
+    varz.update_memcache(
+        'handlers', lambda stored: sorted(set(stored or []) | set([handler])),
+        'profile', PROFILE_TTL)
+
+@contextmanager
+def sampled(request, handler, rate=None):
+    '''Profile the enclosed block if the request is sampled.'''
+    if not should_profile(request, rate):
+        yield None
+        return
+    # The profiler is imported here so unsampled requests never load it
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        try:
+            store_profile(handler, profile)
+        except Exception as error: # pylint: disable=broad-except
+            logging.warn('Unable to store profile for %s: %r',
+                         handler, error)
+
+def top_functions(handler, limit=25, sort='cumulative'):
+    '''Hottest functions of a handler as a list of dicts.
+
+    sort may be 'cumulative', 'total' or 'calls'.
+    '''
+    stored = memcache.get(handler, namespace='profile')
+    if not stored:
+        return {'requests': 0, 'functions': []}
+    stored = json.loads(stored)
+    column = {'calls': 0, 'total': 1, 'cumulative': 2}[sort]
+    functions = sorted(
+        stored['functions'].items(), key=lambda item: -item[1][column])
+    requests = stored['requests']
+    return {
+        'requests': requests,
+        'functions': [{
+            'function': name,
+            'calls': calls,
+            'total': total,
+            'cumulative': cumulative,
+            'cumulative_per_request': cumulative / requests,
+        } for name, (calls, total, cumulative) in functions[:limit]],
+    }
+
+def profiled_handlers():
+    stored = memcache.get('handlers', namespace='profile')
+    if stored:
+        return json.loads(stored)
+    return []
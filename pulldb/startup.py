@@ -0,0 +1,132 @@
+#pylint: disable=missing-docstring
+'''Cold start measurement and warmup.
+
+import_times records how long each module takes to import, excluding the
+time spent importing its own dependencies, so the modules which slow down
+a new instance can be found.  warmup preloads the state that the first
+request would otherwise pay for.
+
+Run as a script to report import times for the handler modules:
+
+    python -m pulldb.startup [module ...]
+'''
+import __builtin__
+from contextlib import contextmanager
+import logging
+import sys
+from time import time
+
+# Modules imported by a typical handler, in the order handlers import them
+DEFAULT_MODULES = [
+    'pulldb.base',
+    'pulldb.models.issues',
+    'pulldb.models.pulls',
+    'pulldb.models.queries',
+]
+
+
+def loading(name, fromlist):
+    '''Name of the module an import statement will load, if any.
+
+    from package import module only passes the package name, so the
+    fromlist is checked for submodules which are not yet loaded.
+    '''
+    if name not in sys.modules:
+        return name
+    for item in fromlist or []:
+        module = '%s.%s' % (name, item)
+        if module not in sys.modules:
+            return module
+
+@contextmanager
+def import_timer():
+    '''Record the self time of each module first imported in the block.
+
+    Yields a dict of module name to [self seconds, total seconds].
+    '''
+    times = {}
+    stack = []
+    original_import = __builtin__.__import__
+
+    def timed_import(name, globals_=None, locals_=None, fromlist=None,
+                     *args):
+        module = loading(name, fromlist)
+        if not module:
+            return original_import(name, globals_, locals_, fromlist, *args)
+        stack.append(0.0)
+        start = time()
+        try:
+            return original_import(name, globals_, locals_, fromlist, *args)
+        finally:
+            total = time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += total
+            if module in sys.modules and module not in times:
+                times[module] = [total - children, total]
+
+    __builtin__.__import__ = timed_import
+    try:
+        yield times
+    finally:
+        __builtin__.__import__ = original_import
+
+def import_times(modules=None):
+    '''Import modules and return [(module, self, total)] slowest first.
+
+    Modules already imported in this process are not measured again, so
+    this is only meaningful early in the life of a process.
+    '''
+    with import_timer() as times:
+        for module in modules or DEFAULT_MODULES:
+            __import__(module)
+    return sorted(
+        ((name, self_time, total)
+         for name, (self_time, total) in times.items()),
+        key=lambda entry: -entry[1])
+
+@contextmanager
+def timed(timings, step):
+    start = time()
+    try:
+        yield
+    except Exception as error: # pylint: disable=broad-except
+        logging.warn('Warmup step %s failed: %r', step, error)
+    finally:
+        timings[step] = time() - start
+
+def warmup():
+    '''Load the state the first request would otherwise pay for.
+
+    Each step is timed and a failed step does not stop the others.
+    Returns a dict of step name to seconds.
+    '''
+    timings = {}
+    with timed(timings, 'imports'):
+        for module in DEFAULT_MODULES:
+            __import__(module)
+    # Imported here so that timing the imports above is meaningful
+    from pulldb import base
+    from pulldb.models import comicvine
+    from pulldb.models import publishers
+    with timed(timings, 'templates'):
+        base.precompile_templates()
+    with timed(timings, 'comicvine'):
+        # Loads the api key and the resource types
+        comicvine.load()
+    with timed(timings, 'publishers'):
+        publishers.warm_cache()
+    logging.info('Warmup complete: %r', timings)
+    return timings
+
+def report(modules=None, limit=30):
+    entries = import_times(modules)
+    lines = ['%-50s %8s %8s' % ('module', 'self ms', 'total ms')]
+    for name, self_time, total in entries[:limit]:
+        lines.append('%-50s %8.1f %8.1f' % (
+            name, self_time * 1000, total * 1000))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    sys.stdout.write(report(sys.argv[1:] or None) + '\n')
@@ -0,0 +1,128 @@
+#pylint: disable=missing-docstring
+import calendar
+from datetime import datetime, timedelta
+from email.utils import formatdate
+import unittest
+
+from google.appengine.ext import ndb # pylint: disable=import-error
+from google.appengine.ext import testbed # pylint: disable=import-error
+import webapp2 # pylint: disable=import-error
+
+from pulldb import base
+from pulldb import varz
+
+CHANGED = datetime(2014, 2, 3, 12, 30)
+
+
+class Thing(ndb.Model):
+    # pylint: disable=no-init,too-few-public-methods
+    changed = ndb.DateTimeProperty()
+    name = ndb.StringProperty()
+
+
+class Unversioned(ndb.Model):
+    # pylint: disable=no-init,too-few-public-methods
+    name = ndb.StringProperty()
+
+
+def http_date(value):
+    return formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+
+
+class ValidatorsTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='pulldb')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_last_modified_is_latest_change(self):
+        things = [
+            Thing(id='a', changed=CHANGED),
+            Thing(id='b', changed=CHANGED + timedelta(hours=1)),
+        ]
+        _, last_modified = base.validators(things)
+        self.assertEqual(CHANGED + timedelta(hours=1), last_modified)
+
+    def test_etag_follows_changes(self):
+        etag, _ = base.validators([Thing(id='a', changed=CHANGED)])
+        same, _ = base.validators([Thing(id='a', changed=CHANGED)])
+        later, _ = base.validators(
+            [Thing(id='a', changed=CHANGED + timedelta(seconds=1))])
+        self.assertEqual(etag, same)
+        self.assertNotEqual(etag, later)
+
+    def test_unversioned_models_use_content(self):
+        etag, last_modified = base.validators([Unversioned(id='a', name='x')])
+        changed, _ = base.validators([Unversioned(id='a', name='y')])
+        self.assertNotEqual(etag, changed)
+        self.assertEqual(None, last_modified)
+
+    def test_keys_identify_membership(self):
+        etag, last_modified = base.validators([ndb.Key(Thing, 'a')])
+        other, _ = base.validators([ndb.Key(Thing, 'b')])
+        self.assertNotEqual(etag, other)
+        self.assertEqual(None, last_modified)
+
+    def test_modified_since(self):
+        self.assertTrue(base.modified_since(CHANGED, http_date(CHANGED)))
+        self.assertTrue(base.modified_since(
+            CHANGED, http_date(CHANGED + timedelta(minutes=1))))
+        self.assertFalse(base.modified_since(
+            CHANGED, http_date(CHANGED - timedelta(minutes=1))))
+        self.assertFalse(base.modified_since(CHANGED, 'not a date'))
+        self.assertFalse(base.modified_since(None, http_date(CHANGED)))
+
+
+class NotModifiedTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='pulldb')
+        self.testbed.init_memcache_stub()
+        self.things = [Thing(id='a', changed=CHANGED)]
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def handler(self, headers=None):
+        request = webapp2.Request.blank('/', headers=headers or [])
+        handler = base.BaseHandler(request, webapp2.Response())
+        handler.varz = varz.Varz(name='handler')
+        return handler
+
+    def test_sets_validators(self):
+        handler = self.handler()
+        self.assertFalse(handler.not_modified(self.things, max_age=60))
+        etag, _ = base.validators(self.things)
+        headers = handler.response.headers
+        self.assertEqual(etag, headers['ETag'])
+        self.assertEqual(http_date(CHANGED), headers['Last-Modified'])
+        self.assertEqual('private, max-age=60, must-revalidate',
+                         headers['Cache-Control'])
+
+    def test_matching_etag(self):
+        etag, _ = base.validators(self.things)
+        handler = self.handler([('If-None-Match', '"other", %s' % etag)])
+        self.assertTrue(handler.not_modified(self.things))
+        self.assertEqual(304, handler.response.status_int)
+        self.assertTrue(handler.varz.not_modified)
+
+    def test_stale_etag(self):
+        handler = self.handler([('If-None-Match', '"other"')])
+        self.assertFalse(handler.not_modified(self.things))
+        self.assertEqual(200, handler.response.status_int)
+
+    def test_etag_takes_precedence_over_date(self):
+        handler = self.handler([
+            ('If-None-Match', '"other"'),
+            ('If-Modified-Since', http_date(CHANGED)),
+        ])
+        self.assertFalse(handler.not_modified(self.things))
+
+    def test_if_modified_since(self):
+        handler = self.handler([('If-Modified-Since', http_date(CHANGED))])
+        self.assertTrue(handler.not_modified(self.things))
+        self.assertEqual(304, handler.response.status_int)
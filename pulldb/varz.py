@@ -1,14 +1,51 @@
 #pylint: disable=missing-docstring
+import functools
+import json
 import logging
+from random import random
+import re
+import threading
 from time import time
 
+from google.appengine.api import memcache
+
+# Upper bounds in seconds of the latency histogram buckets.  Anything
+# slower is counted in a final overflow bucket.
+LATENCY_BUCKETS = [
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+]
+# Fraction of successful varz which are logged.  Errors are always logged.
+LOG_SAMPLE_RATE = 0.01
+# Seconds between flushes of the in-process metrics to memcache, and the
+# width of the aggregation windows they are flushed into.
+FLUSH_INTERVAL = 60
+WINDOW_TTL = 24 * 3600
+# Child spans kept per span in a trace
+MAX_CHILD_SPANS = 200
+# Default api call budgets per request.  Keys are a service, a
+# service.call or 'total'.  Handlers may override with rpc_budgets.
+RPC_BUDGETS = {
+    'datastore_v3': 100,
+    'datastore_v3.RunQuery': 20,
+    'memcache': 100,
+    'total': 150,
+}
+
+_URL_IDS = re.compile(r'\d+')
+
 class VarzContext(object):
     '''Decorate a hander within a Varz context.
 
     This class behaves both as a decorator and a context handler.  The
     handler method decorated will have a context varz installed into
     its instance.  When the handler method returns the content of the
-    varz will be logged.
+    varz will be recorded.
+
+    Varz are held in a thread local stack of spans so concurrent requests
+    never share them.  A varz started within another becomes its child,
+    and the outermost span emits a trace of the whole tree when it ends.
+    Work which runs interleaved in tasklets should use start() and stop(),
+    which attach to the current span without changing the stack.
     '''
     #pylint: disable=too-few-public-methods
     def __init__(self, context):
@@ -16,25 +53,49 @@ class VarzContext(object):
         self.varz = None
 
     def __call__(self, method, *args, **kwargs):
-        logging.debug('Entering Varz context %r', self.context)
+        context = self.context
+        @functools.wraps(method)
         def wrap(instance, *args, **kwargs):
-            with self:
-                self.varz = Varz(name=self.context)
-                instance.varz = self.varz
+            current = current_varz()
+            if current and current is getattr(instance, 'varz', None) and (
+                    current.name == context):
+                # Overridden methods share the span of the outermost call
+                return method(instance, *args, **kwargs)
+            with VarzContext(context) as varz:
+                instance.varz = varz
                 return method(instance, *args, **kwargs)
 
         return wrap
 
     def __enter__(self):
-        pass
+        self.start()
+        _spans().append(self.varz)
+        return self.varz
 
     def __exit__(self, exc_type, exc_value, traceback):
+        stack = _spans()
+        if self.varz in stack:
+            stack.remove(self.varz)
         if exc_type and not self.varz.status:
-            self.varz.status=500
-        logging.info('varz: %r', self.varz)
+            # HTTP exceptions such as abort(404) carry their status
+            self.varz.status = exception_status(exc_value)
+        self.varz.finish()
+        # pylint: disable=protected-access
+        if self.varz.parent is None and self.varz._rpc_stats:
+            self.varz._rpc_stats.summarise(
+                self.varz, self.varz._rpc_budgets)
+        REGISTRY.record(self.varz)
+        if self.varz.parent is None:
+            if is_error(self.varz) or random() < LOG_SAMPLE_RATE:
+                logging.info('trace: %s', self.varz.trace())
 
-    def start(self):
+    def start(self, parent=None):
+        if parent is None:
+            parent = current_varz()
         self.varz = Varz(name=self.context)
+        if parent is not None:
+            parent.add_child(self.varz)
+        return self.varz
 
     def stop(self):
         return self.__exit__(None, None, None)
@@ -44,6 +105,12 @@ class Varz(object):
     #pylint: disable=too-few-public-methods
     def __init__(self, **kwargs):
         self._start_time = time()
+        self._end_time = None
+        self._children = []
+        self._dropped = 0
+        self._parent = None
+        self._rpc_stats = None
+        self._rpc_budgets = None
         self._varz = kwargs
 
     def __getattr__(self, attribute):
@@ -58,7 +125,425 @@ class Varz(object):
         else:
             self._varz[attribute] = value
 
+    @property
+    def parent(self):
+        return self._parent
+
+    @property
+    def children(self):
+        return self._children
+
+    @property
+    def elapsed(self):
+        return (self._end_time or time()) - self._start_time
+
+    @property
+    def rpc_stats(self):
+        if self._rpc_stats is None:
+            self._rpc_stats = RpcStats()
+        return self._rpc_stats
+
+    def set_rpc_budgets(self, budgets):
+        self._rpc_budgets = budgets
+
+    def add_child(self, child):
+        child._parent = self # pylint: disable=protected-access
+        if len(self._children) < MAX_CHILD_SPANS:
+            self._children.append(child)
+        else:
+            self._dropped += 1
+
+    def finish(self):
+        if self._end_time is None:
+            self._end_time = time()
+        self._varz['elapsed'] = self.elapsed
+
+    def trace(self):
+        '''Render this span and its children as a single line.'''
+        trace = '%s(%r)' % (self.name, self)
+        if self._children:
+            children = [child.trace() for child in self._children]
+            if self._dropped:
+                children.append('...%d more' % self._dropped)
+            trace += ' [%s]' % ', '.join(children)
+        return trace
+
     def __repr__(self):
-        self._varz['elapsed'] = time() - self._start_time
+        self._varz['elapsed'] = self.elapsed
         stats = ['%s=%s' % item for item in self._varz.items()]
         return ' '.join(stats)
+
+
+_LOCAL = threading.local()
+
+def _spans():
+    if not hasattr(_LOCAL, 'spans'):
+        _LOCAL.spans = []
+    return _LOCAL.spans
+
+def current_varz():
+    '''Innermost varz of the current thread, or None.'''
+    spans = _spans()
+    if spans:
+        return spans[-1]
+
+def root_varz():
+    '''Outermost varz of the current thread, or None.'''
+    spans = _spans()
+    if spans:
+        return spans[0]
+
+def record_rpc(service, call, start, end, error=None, request=None):
+    '''Attach a completed api call as a child span of the current varz.
+
+    The call is also counted against the outermost varz of the request.
+    '''
+    parent = current_varz()
+    if parent is None:
+        return None
+    span = Varz(name='%s.%s' % (service, call))
+    span._start_time = start # pylint: disable=protected-access
+    span._end_time = end # pylint: disable=protected-access
+    if error:
+        span.error = error
+    models, items = rpc_details(service, call, request)
+    if models:
+        span.models = ','.join(sorted(set(models)))
+    if items:
+        span.items = items
+    parent.add_child(span)
+    span.finish()
+    root_varz().rpc_stats.add(service, call, end - start, models, items)
+    return span
+
+def rpc_details(service, call, request):
+    '''Model kinds and batch size of a datastore or memcache request.'''
+    # pylint: disable=too-many-return-statements
+    if request is None:
+        return [], 0
+    try:
+        if service == 'datastore_v3':
+            if call in ('Get', 'Delete'):
+                keys = request.key_list()
+                return [key_kind(key) for key in keys], len(keys)
+            if call == 'Put':
+                entities = request.entity_list()
+                return [key_kind(entity.key()) for entity in entities], len(
+                    entities)
+            if call == 'RunQuery':
+                return [request.kind()], 1
+        if service == 'memcache':
+            for size in ('key_size', 'item_size'):
+                if hasattr(request, size):
+                    return [], getattr(request, size)()
+    except Exception as error: # pylint: disable=broad-except
+        logging.debug('Unable to inspect %s.%s: %r', service, call, error)
+    return [], 0
+
+def key_kind(key):
+    return key.path().element_list()[-1].type()
+
+
+class RpcStats(object):
+    '''Api call totals for a request, by call and by model.'''
+    def __init__(self):
+        self.calls = {}
+        self.models = {}
+        self.count = 0
+        self.items = 0
+        self.time = 0.0
+
+    def add(self, service, call, elapsed, models=None, items=0):
+        # pylint: disable=too-many-arguments
+        name = '%s.%s' % (service, call)
+        stats = self.calls.setdefault(name, {'count': 0, 'time': 0.0,
+                                             'items': 0, 'max_batch': 0})
+        stats['count'] += 1
+        stats['time'] += elapsed
+        stats['items'] += items
+        stats['max_batch'] = max(stats['max_batch'], items)
+        for model in set(models or []):
+            model_name = '%s.%s' % (model, call)
+            self.models[model_name] = self.models.get(model_name, 0) + 1
+        self.count += 1
+        self.items += items
+        self.time += elapsed
+
+    def service_count(self, service):
+        return sum(stats['count'] for name, stats in self.calls.items()
+                   if name.startswith(service + '.'))
+
+    def over_budget(self, budgets):
+        '''Budget names exceeded by the request.
+
+        budgets maps a service, service.call or 'total' to a maximum count.
+        '''
+        exceeded = []
+        for name, limit in sorted(budgets.items()):
+            if name == 'total':
+                count = self.count
+            elif '.' in name:
+                count = self.calls.get(name, {}).get('count', 0)
+            else:
+                count = self.service_count(name)
+            if count > limit:
+                exceeded.append('%s=%d>%d' % (name, count, limit))
+        return exceeded
+
+    def summarise(self, varz, budgets=None):
+        '''Attach the totals to a varz and flag exceeded budgets.'''
+        if not self.count:
+            return
+        varz.rpc_count = self.count
+        varz.rpc_items = self.items
+        varz.rpc_time = round(self.time, 4)
+        varz.rpcs = ','.join(
+            '%s:%d' % (name, stats['count'])
+            for name, stats in sorted(self.calls.items()))
+        varz.rpc_models = ','.join(
+            '%s:%d' % item for item in sorted(self.models.items()))
+        exceeded = self.over_budget(budgets or RPC_BUDGETS)
+        if exceeded:
+            varz.rpc_over_budget = ','.join(exceeded)
+            logging.warn('Request over rpc budget: %s (%s)',
+                         varz.rpc_over_budget, varz.rpcs)
+
+
+class _RpcTimer(object):
+    '''apiproxy hooks which time datastore and memcache calls.'''
+    def __init__(self):
+        self.local = threading.local()
+
+    def _started(self):
+        if not hasattr(self.local, 'started'):
+            self.local.started = {}
+        return self.local.started
+
+    def pre_call(self, service, call, request, response, rpc=None):
+        # pylint: disable=unused-argument
+        self._started()[id(rpc or response)] = time()
+
+    def post_call(self, service, call, request, response, rpc=None,
+                  error=None):
+        # pylint: disable=unused-argument,too-many-arguments
+        start = self._started().pop(id(rpc or response), None)
+        if start is not None:
+            record_rpc(service, call, start, time(), error, request)
+
+
+RPC_TIMER = _RpcTimer()
+RPC_SERVICES = ['datastore_v3', 'memcache']
+
+def install_rpc_hooks():
+    '''Install api call timing.  Safe to call more than once.'''
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy = apiproxy_stub_map.apiproxy
+    for service in RPC_SERVICES:
+        apiproxy.GetPreCallHooks().Append(
+            'varz_%s' % service, RPC_TIMER.pre_call, service)
+        apiproxy.GetPostCallHooks().Append(
+            'varz_%s' % service, RPC_TIMER.post_call, service)
+
+
+def install_shutdown_hook():
+    '''Flush metrics when the instance is stopped.
+
+    Only manual and basic scaling instances are notified of shutdown.
+    Metrics of other instances are flushed by their next request.
+    '''
+    from google.appengine.api import runtime
+    runtime.set_shutdown_hook(REGISTRY.flush)
+
+
+def exception_status(error):
+    code = getattr(error, 'code', None)
+    if isinstance(code, int) and 100 <= code < 600:
+        return code
+    return 500
+
+def is_error(varz):
+    return (varz.status or 0) >= 500 or (varz.http_status or 0) >= 500
+
+def url_template(url):
+    '''Reduce a url to a template by removing query and identifiers.'''
+    if not url:
+        return ''
+    return _URL_IDS.sub('{id}', url.split('?', 1)[0])
+
+
+class Histogram(object):
+    '''Fixed bucket latency histogram.'''
+    def __init__(self, buckets=None, count=0, total=0.0, errors=0):
+        self.buckets = buckets or [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = count
+        self.errors = errors
+        self.total = total
+
+    def add(self, value, error=False):
+        index = 0
+        while index < len(LATENCY_BUCKETS) and value > LATENCY_BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        if error:
+            self.errors += 1
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+
+    def percentile(self, fraction):
+        '''Upper bound of the bucket containing the given percentile.'''
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= target:
+                if index < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[index]
+                break
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'buckets': self.buckets,
+            'count': self.count,
+            'errors': self.errors,
+            'total': self.total,
+        }
+
+    def summary(self):
+        summary = self.to_dict()
+        summary.update({
+            'mean': self.total / self.count if self.count else None,
+            'error_rate': 1.0 * self.errors / self.count if self.count else 0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+        })
+        return summary
+
+
+class MetricsRegistry(object):
+    '''In process aggregation of varz.
+
+    Varz are keyed by context, handler type, status and url template.
+    Metrics are merged into a memcache window shared by all instances,
+    from where aggregate() reads them.  Metrics are held until the first
+    varz recorded after their window ends, and are then merged into the
+    window they were recorded in, so an instance which was idle flushes
+    its last window late rather than into the wrong window.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._window = current_window()
+
+    @staticmethod
+    def label(varz):
+        return '|'.join([
+            str(varz.name or ''),
+            str(varz.handler_type or ''),
+            str(varz.status or 0),
+            url_template(varz.url),
+        ])
+
+    def record(self, varz):
+        # pylint: disable=protected-access
+        latency = varz.latency
+        if latency is None:
+            latency = time() - varz._start_time
+        label = self.label(varz)
+        window = current_window()
+        with self._lock:
+            if window != self._window:
+                ended = self._swap(window)
+            else:
+                ended = None
+            if label not in self._metrics:
+                self._metrics[label] = Histogram()
+            self._metrics[label].add(latency, is_error(varz))
+        if ended:
+            self._merge(*ended)
+
+    def _swap(self, window):
+        ended = (self._window, self._metrics)
+        self._window, self._metrics = window, {}
+        return ended
+
+    def flush(self):
+        with self._lock:
+            ended = self._swap(current_window())
+        self._merge(*ended)
+
+    @staticmethod
+    def _merge(window, metrics):
+        if not metrics:
+            return
+        try:
+            merge_window(window, metrics)
+        except Exception as error: # pylint: disable=broad-except
+            logging.warn('Unable to flush varz metrics: %r', error)
+
+
+def current_window():
+    return int(time() // FLUSH_INTERVAL)
+
+def window_key(window):
+    return 'window:%d' % window
+
+def update_memcache(key, update, namespace, ttl=0, retries=5):
+    '''Apply update to a json value in memcache using compare and set.
+
+    update is passed the current value (None if missing) and returns the
+    new value.  Returns False if the value could not be updated.
+    '''
+    client = memcache.Client()
+    for _ in range(retries):
+        stored = client.gets(key, namespace=namespace)
+        if stored is None:
+            value = update(None)
+            if client.add(key, json.dumps(value), ttl, namespace=namespace):
+                return True
+        else:
+            value = update(json.loads(stored))
+            if client.cas(key, json.dumps(value), ttl, namespace=namespace):
+                return True
+    logging.warn('Gave up updating %s:%s in memcache', namespace, key)
+    return False
+
+def merge_window(window, metrics):
+    def merge(stored):
+        merged = stored or {}
+        for label, histogram in metrics.items():
+            current = Histogram(**merged.get(label, {}))
+            current.merge(histogram)
+            merged[label] = current.to_dict()
+        return merged
+    return update_memcache(window_key(window), merge, 'varz', WINDOW_TTL)
+
+def aggregate(minutes=60):
+    '''Merge the flushed metrics of the last few windows.
+
+    Returns a dict of label to histogram summary.
+    '''
+    latest = current_window()
+    windows = range(latest - minutes * 60 // FLUSH_INTERVAL, latest + 1)
+    stored = memcache.get_multi(
+        [window_key(window) for window in windows], namespace='varz')
+    totals = {}
+    for data in stored.values():
+        for label, histogram in json.loads(data).items():
+            if label not in totals:
+                totals[label] = Histogram()
+            totals[label].merge(Histogram(**histogram))
+    return dict(
+        (label, histogram.summary()) for label, histogram in totals.items())
+
+
+REGISTRY = MetricsRegistry()